@@ -0,0 +1,299 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from pathlib import Path
+
+from data.compression import detect_compression
+from util import read_file, write_file_atomic
+
+logger = logging.getLogger("opendapViz")
+
+
+class CacheBackend(object):
+    """
+    Storage of a `CachedProvider`: maps keys, the request uris, to raw response bytes.
+    """
+
+    def read(self, key: str):
+        """
+        :return: the stored bytes or None
+        """
+        raise NotImplementedError()
+
+    def write(self, key: str, content: bytes):
+        raise NotImplementedError()
+
+    def delete(self, key: str):
+        """
+        Removes the entry of `key`, if any.
+        """
+        raise NotImplementedError()
+
+    def close(self):
+        pass
+
+
+class MirrorCacheBackend(CacheBackend):
+    """
+    Mirrors the remote uri below `cache_dir`, one file per response.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = Path(cache_dir)
+
+    def read(self, key: str):
+        try:
+            return read_file(self.cache_dir / key.lstrip("/"), "rb")
+        except FileNotFoundError:
+            return None
+
+    def write(self, key: str, content: bytes):
+        write_file_atomic(content, self.cache_dir / key.lstrip("/"), "wb")
+
+    def delete(self, key: str):
+        try:
+            os.unlink(str(self.cache_dir / key.lstrip("/")))
+        except FileNotFoundError:
+            pass
+
+
+class ShardedCacheBackend(CacheBackend):
+    """
+    Stores responses content-addressed by the SHA-1 of their key in `objects/ab/cd/<sha1>`. An index of all entries
+    with their size and last access time is kept in `index.json`. If `max_size` is set, the least recently used
+    entries are evicted once the total size exceeds it.
+
+    Changes of the index are appended to `index.log` in batches of `flush_interval`, the index itself is only
+    rewritten on `close` and once the log outgrows it.
+    """
+    INDEX_FILE = "index.json"
+    # one JSON list per line: [digest, size, last access], or [digest] if the entry was removed
+    LOG_FILE = "index.log"
+
+    def __init__(self, cache_dir, max_size=None, flush_interval=100):
+        self.cache_dir = Path(cache_dir)
+        self.max_size = max_size
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        # log records not yet appended
+        self._changes = []
+        self._logged = 0
+        # digest -> [size, last access], least recently used first
+        self._entries = self._load_index()
+        self._total_size = sum(size for size, _ in self._entries.values())
+
+    @staticmethod
+    def _digest(key: str):
+        return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+    def _object_path(self, digest):
+        return self.cache_dir / "objects" / digest[:2] / digest[2:4] / digest
+
+    def _load_index(self):
+        content = read_file(self.cache_dir / self.INDEX_FILE, "r")
+        if content is not None:
+            try:
+                entries = json.loads(content)
+                return self._replay_log(OrderedDict(sorted(entries.items(), key=lambda item: item[1][1])))
+            except ValueError:
+                logger.warning("Broken cache index, rebuilding it: %s" % self.cache_dir)
+
+        entries = []
+        for path in (self.cache_dir / "objects").glob("*/*/*"):
+            if not path.name.startswith("."):
+                stat = path.stat()
+                entries.append((path.name, [stat.st_size, stat.st_mtime]))
+        return self._replay_log(OrderedDict(sorted(entries, key=lambda item: item[1][1])))
+
+    def _replay_log(self, entries):
+        content = read_file(self.cache_dir / self.LOG_FILE, "r")
+        if content is None:
+            return entries
+        lines = content.splitlines()
+        for line in lines:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # e.g. the incomplete last line of a killed process
+                continue
+            entries.pop(record[0], None)
+            if len(record) == 3:
+                entries[record[0]] = record[1:]
+        self._logged = len(lines)
+        return entries
+
+    def _touch(self, digest, size):
+        # called with the lock held, moves the entry to the most recently used end
+        previous = self._entries.pop(digest, None)
+        if previous is not None:
+            self._total_size -= previous[0]
+        self._entries[digest] = [size, time.time()]
+        self._total_size += size
+        self._changes.append([digest] + self._entries[digest])
+
+    def _remove(self, digest):
+        # called with the lock held
+        self._total_size -= self._entries.pop(digest)[0]
+        self._changes.append([digest])
+
+    def _evict(self):
+        while self.max_size is not None and self._total_size > self.max_size and len(self._entries) > 1:
+            digest = next(iter(self._entries))
+            self._remove(digest)
+            try:
+                os.unlink(str(self._object_path(digest)))
+            except FileNotFoundError:
+                pass
+            logger.debug("Evicted cache entry: %s" % digest)
+
+    def read(self, key: str):
+        digest = self._digest(key)
+        try:
+            content = read_file(self._object_path(digest), "rb")
+        except FileNotFoundError:
+            content = None
+
+        with self._lock:
+            if content is None:
+                if digest in self._entries:
+                    self._remove(digest)
+            else:
+                self._touch(digest, len(content))
+        return content
+
+    def write(self, key: str, content: bytes):
+        digest = self._digest(key)
+        write_file_atomic(content, self._object_path(digest), "wb")
+
+        with self._lock:
+            self._touch(digest, len(content))
+            self._evict()
+            if len(self._changes) >= self.flush_interval:
+                self._flush()
+
+    def delete(self, key: str):
+        digest = self._digest(key)
+        try:
+            os.unlink(str(self._object_path(digest)))
+        except FileNotFoundError:
+            pass
+
+        with self._lock:
+            if digest in self._entries:
+                self._remove(digest)
+
+    def _flush(self, compact=False):
+        # called with the lock held
+        if not self._changes and not (compact and self._logged):
+            return
+        # rewriting the index only once the log is longer keeps the total cost linear in the number of changes
+        if compact or self._logged + len(self._changes) > 2 * len(self._entries) + self.flush_interval:
+            write_file_atomic(json.dumps(self._entries), self.cache_dir / self.INDEX_FILE, "w")
+            # a log left over by a crash in between is older than the index, replaying it only adds stale entries
+            try:
+                os.unlink(str(self.cache_dir / self.LOG_FILE))
+            except FileNotFoundError:
+                pass
+            self._logged = 0
+        else:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            with open(str(self.cache_dir / self.LOG_FILE), "a") as file:
+                file.write("".join(json.dumps(record) + "\n" for record in self._changes))
+            self._logged += len(self._changes)
+        self._changes = []
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def close(self):
+        with self._lock:
+            self._flush(compact=True)
+
+
+class SQLiteCacheBackend(CacheBackend):
+    """
+    Stores all responses zlib compressed in the single database file `cache_dir/cache.sqlite`, which avoids the
+    file system metadata operations of one file per response. Already compressed content is stored as is.
+    Writes are buffered and committed in batches of `batch_size` entries and on `close`.
+    """
+    DATABASE_FILE = "cache.sqlite"
+
+    def __init__(self, cache_dir, batch_size=200):
+        self.path = Path(cache_dir) / self.DATABASE_FILE
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.batch_size = batch_size
+        self._lock = threading.Lock()
+        self._pending = {}
+        # shared by the crawler threads, access is serialized by the lock
+        self._connection = sqlite3.connect(str(self.path), check_same_thread=False)
+        self._connection.execute("CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, content BLOB NOT NULL)")
+        self._connection.commit()
+
+    def read(self, key: str):
+        with self._lock:
+            content = self._pending.get(key)
+            if content is None:
+                row = self._connection.execute("SELECT content FROM entries WHERE key = ?", (key,)).fetchone()
+                if row is None:
+                    return None
+                content = row[0]
+        if detect_compression(content) != "none":
+            return content
+        return zlib.decompress(content)
+
+    def write(self, key: str, content: bytes):
+        if detect_compression(content) == "none":
+            content = zlib.compress(content)
+        with self._lock:
+            self._pending[key] = content
+            if len(self._pending) >= self.batch_size:
+                self._commit()
+
+    def delete(self, key: str):
+        with self._lock:
+            self._pending.pop(key, None)
+            with self._connection:
+                self._connection.execute("DELETE FROM entries WHERE key = ?", (key,))
+
+    def _commit(self):
+        with self._connection:
+            self._connection.executemany("INSERT OR REPLACE INTO entries (key, content) VALUES (?, ?)",
+                                         self._pending.items())
+        logger.debug("Committed %d cache entries to: %s", len(self._pending), self.path)
+        self._pending = {}
+
+    def close(self):
+        with self._lock:
+            if self._connection is None:
+                return
+            if self._pending:
+                self._commit()
+            self._connection.close()
+            self._connection = None
+
+
+CACHE_LAYOUTS = ("mirror", "sharded", "sqlite")
+
+
+def create_cache_backend(layout, cache_dir, max_size=None):
+    """
+    :param layout: one of `CACHE_LAYOUTS`
+    :param max_size: maximum size in bytes, only supported by the sharded layout
+    """
+    if max_size is not None and layout != "sharded":
+        logger.warning("The %s cache layout does not support a maximum size" % layout)
+
+    if layout == "mirror":
+        return MirrorCacheBackend(cache_dir)
+    elif layout == "sharded":
+        return ShardedCacheBackend(cache_dir, max_size)
+    elif layout == "sqlite":
+        return SQLiteCacheBackend(cache_dir)
+    raise ValueError("Unknown cache layout: %s" % layout)
@@ -0,0 +1,55 @@
+import gzip
+import logging
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger("opendapViz")
+
+COMPRESSIONS = ("none", "gzip", "zstd")
+
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+
+def detect_compression(content: bytes):
+    """
+    :return: `gzip`, `zstd` or `none`, detected from the magic number of `content`
+    """
+    if content.startswith(GZIP_MAGIC):
+        return "gzip"
+    if content.startswith(ZSTD_MAGIC):
+        return "zstd"
+    return "none"
+
+
+def check_compression(compression):
+    if compression not in COMPRESSIONS:
+        raise ValueError("Unknown compression: %s" % compression)
+    if compression == "zstd" and zstandard is None:
+        raise ValueError("zstd compression requires the zstandard package")
+
+
+def compress(content: bytes, compression):
+    if compression == "gzip":
+        return gzip.compress(content)
+    if compression == "zstd":
+        return zstandard.ZstdCompressor().compress(content)
+    return content
+
+
+def decompress(content: bytes):
+    """
+    Decompresses gzip or zstd compressed content, anything else is returned unchanged.
+    """
+    compression = detect_compression(content)
+    if compression == "gzip":
+        return gzip.decompress(content)
+    if compression == "zstd":
+        if zstandard is None:
+            raise ValueError("Reading zstd compressed data requires the zstandard package")
+        # streaming API, the frame may not contain the content size
+        return zstandard.ZstdDecompressor().decompressobj().decompress(content)
+    return content
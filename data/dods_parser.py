@@ -0,0 +1,59 @@
+import logging
+import re
+
+import numpy
+
+logger = logging.getLogger("opendapViz")
+
+# DAP2 atomic types and their XDR encoding. 16 bit integers are transferred as 32 bit values.
+DAP_TYPES = {
+    "Byte": numpy.dtype("u1"),
+    "Int16": numpy.dtype(">i4"),
+    "UInt16": numpy.dtype(">u4"),
+    "Int32": numpy.dtype(">i4"),
+    "UInt32": numpy.dtype(">u4"),
+    "Float32": numpy.dtype(">f4"),
+    "Float64": numpy.dtype(">f8"),
+}
+
+DATA_SEPARATOR = b"\nData:\n"
+
+_array_declaration = re.compile(r"^\s*(%s)\s+[^\s\[]+\s*((?:\[[^\]]*\]\s*)+);" % "|".join(DAP_TYPES),
+                                re.MULTILINE)
+_array_dimension = re.compile(r"\[(?:[^\]=]*=)?\s*(\d+)\s*\]")
+_constructor_declaration = re.compile(r"^\s*(Structure|Sequence)\s*\{", re.MULTILINE)
+
+
+class DodsParseError(ValueError):
+    pass
+
+
+def parse_dods_array(data: bytes) -> numpy.ndarray:
+    """
+    Decodes a DAP2 `.dods` response containing a single array of an atomic type, e.g. the answer to
+    `<dataset>.dods?time[0:1:3]`. For a `Grid`, e.g. `<dataset>.dods?t[0:1:0][0:1:99][0:1:99]`, only the data
+    array is decoded and the map vectors following it are ignored.
+
+    :param data: raw response, the DDS followed by the XDR encoded data
+    :return: the values as a native byte order numpy array with the declared shape
+    """
+    separator = data.find(DATA_SEPARATOR)
+    if separator < 0:
+        raise DodsParseError("No data section found")
+
+    dds = data[:separator].decode("utf-8", "replace")
+    declaration = _array_declaration.search(dds)
+    if declaration is None or _constructor_declaration.search(dds):
+        raise DodsParseError("Only single arrays of atomic types are supported: %s" % dds.strip())
+
+    dtype = DAP_TYPES[declaration.group(1)]
+    shape = tuple(int(size) for size in _array_dimension.findall(declaration.group(2)))
+    payload = data[separator + len(DATA_SEPARATOR):]
+    # arrays start with their length, sent twice
+    count = int(numpy.frombuffer(payload, dtype=">u4", count=1, offset=0)[0])
+    offset = 8
+    if len(payload) < offset + count * dtype.itemsize:
+        raise DodsParseError("Truncated data section: expected %d values" % count)
+
+    values = numpy.frombuffer(payload, dtype=dtype, count=count, offset=offset)
+    return values.astype(dtype.newbyteorder("=")).reshape(shape)
@@ -0,0 +1,232 @@
+import json
+import logging
+import struct
+import threading
+import zipfile
+from pathlib import Path
+from typing import Union
+
+import numpy
+
+from util import read_file, write_file
+
+logger = logging.getLogger("opendapViz")
+
+NPZ_INDEX_EXT = ".npz"
+NDJSON_INDEX_EXT = ".ndjson"
+# string fields of the dataset entries, stored as one column each
+DATASET_FIELDS = ("signature", "schema", "attributes_id")
+
+
+def is_npz_index(file_path: Union[str, Path]):
+    return str(file_path).endswith(NPZ_INDEX_EXT)
+
+
+def is_ndjson_index(file_path: Union[str, Path]):
+    return str(file_path).endswith(NDJSON_INDEX_EXT)
+
+
+def values_to_list(values):
+    """
+    Converts coordinate values loaded from a `.npz` index back to the list representation of a JSON index.
+    """
+    if isinstance(values, numpy.ndarray):
+        if numpy.issubdtype(values.dtype, numpy.datetime64):
+            return numpy.datetime_as_string(values).tolist()
+        return values.tolist()
+    return list(values)
+
+
+def _json_default(default):
+    def parse(o):
+        if isinstance(o, numpy.ndarray):
+            return values_to_list(o)
+        if default is not None:
+            return default(o)
+        raise TypeError("Not JSON serializable: %r" % o)
+
+    return parse
+
+
+def _encode_column(values_per_dataset):
+    """
+    Concatenates the values of all datasets into one array plus offsets. Timestamp strings are stored as
+    datetime64 if they can be restored exactly.
+    """
+    values_per_dataset = list(map(values_to_list, values_per_dataset))
+    flat = [value for values in values_per_dataset for value in values]
+    offsets = numpy.cumsum([0] + [len(values) for values in values_per_dataset], dtype=numpy.int64)
+
+    if flat and all(isinstance(value, str) for value in flat):
+        try:
+            as_dates = numpy.array(flat, dtype="datetime64")
+            if (numpy.datetime_as_string(as_dates) == numpy.array(flat)).all():
+                return as_dates, offsets
+        except ValueError:
+            pass
+        return numpy.array(flat, dtype=str), offsets
+
+    return numpy.array(flat), offsets
+
+
+def save_npz_index(jdata, file_path, default=None):
+    """
+    Saves an index as uncompressed `.npz`: coordinates are stored column wise, one flat array per coordinate
+    plus offsets into it, ids as a string table. Everything but the datasets is kept as JSON header.
+    """
+    datasets = jdata["datasets"]
+    header = {key: value for key, value in jdata.items() if key != "datasets"}
+    coordinate_names = sorted(set(name for ds in datasets for name in ds["data"]))
+
+    arrays = {
+        "header": numpy.array(json.dumps(header, default=_json_default(default))),
+        "ids": numpy.array([ds["id"] for ds in datasets], dtype=str),
+    }
+    for field in DATASET_FIELDS:
+        if any(field in ds for ds in datasets):
+            arrays["fields/%s" % field] = numpy.array([ds.get(field) or "" for ds in datasets], dtype=str)
+    for name in coordinate_names:
+        values, offsets = _encode_column([ds["data"].get(name, []) for ds in datasets])
+        arrays["coords/%s/values" % name] = values
+        arrays["coords/%s/offsets" % name] = offsets
+
+    Path(file_path).parent.mkdir(parents=True, exist_ok=True)
+    numpy.savez(str(file_path), **arrays)
+    logger.debug("File written to: %s", file_path)
+
+
+def _map_npz(file_path):
+    """
+    Memory maps the arrays of an uncompressed `.npz` file, a zip archive of `.npy` files stored as they are.
+    Arrays which can not be mapped, e.g. compressed or empty ones, are read instead.
+
+    :return: dict of the array names and arrays
+    """
+    header_readers = {(1, 0): numpy.lib.format.read_array_header_1_0,
+                      (2, 0): numpy.lib.format.read_array_header_2_0}
+    arrays = {}
+    with zipfile.ZipFile(str(file_path)) as archive, open(str(file_path), "rb") as file:
+        for info in archive.infolist():
+            name = info.filename[:-len(".npy")] if info.filename.endswith(".npy") else info.filename
+            if info.compress_type == zipfile.ZIP_STORED:
+                # the array follows the local file header, whose extra field may differ from the central directory
+                file.seek(info.header_offset)
+                name_length, extra_length = struct.unpack("<HH", file.read(30)[26:30])
+                file.seek(info.header_offset + 30 + name_length + extra_length)
+                header_reader = header_readers.get(numpy.lib.format.read_magic(file))
+                if header_reader is not None:
+                    shape, fortran_order, dtype = header_reader(file)
+                    if not dtype.hasobject and numpy.prod(shape, dtype=numpy.int64) > 0:
+                        arrays[name] = numpy.memmap(str(file_path), dtype, "r", file.tell(), shape,
+                                                    "F" if fortran_order else "C")
+                        continue
+            with archive.open(info) as member:
+                arrays[name] = numpy.lib.format.read_array(member, allow_pickle=False)
+    return arrays
+
+
+def load_npz_index(file_path):
+    """
+    Loads a `.npz` index into the same structure as a JSON index. The columns are memory mapped and the coordinate
+    values of each dataset are numpy views into them instead of lists, so only the values used are read.
+    """
+    npz = _map_npz(file_path)
+    jdata = json.loads(npz["header"].item())
+    ids = npz["ids"].tolist()
+    fields = {field: npz["fields/%s" % field].tolist() for field in DATASET_FIELDS if "fields/%s" % field in npz}
+    columns = {}
+    for key in npz:
+        if key.startswith("coords/") and key.endswith("/values"):
+            name = key[len("coords/"):-len("/values")]
+            columns[name] = (npz[key], npz["coords/%s/offsets" % name])
+
+    datasets = []
+    for i, ds_id in enumerate(ids):
+        data = {}
+        for name, (values, offsets) in columns.items():
+            data[name] = values[offsets[i]:offsets[i + 1]]
+        ds = {"id": ds_id, "data": data}
+        for field, values in fields.items():
+            if values[i]:
+                ds[field] = values[i]
+        datasets.append(ds)
+
+    jdata["datasets"] = datasets
+    return jdata
+
+
+class NdjsonIndexWriter:
+    """
+    Writes an index incrementally as newline delimited JSON: one line per dataset as soon as it is known, and
+    everything else as `{"header": ...}` in the last line. Datasets may be written from several threads.
+    """
+
+    def __init__(self, file_path, default=None):
+        Path(file_path).parent.mkdir(parents=True, exist_ok=True)
+        self.file_path = file_path
+        self._default = _json_default(default)
+        self._lock = threading.Lock()
+        self._file = open(str(file_path), "w")
+
+    def write_dataset(self, ds):
+        line = json.dumps(ds, default=self._default)
+        with self._lock:
+            self._file.write(line + "\n")
+
+    def close(self, header):
+        with self._lock:
+            self._file.write(json.dumps({"header": header}, default=self._default) + "\n")
+            self._file.close()
+        logger.debug("File written to: %s", self.file_path)
+
+
+def load_ndjson_index(file_path):
+    header = None
+    datasets = []
+    with open(str(file_path), "r") as file:
+        for line in file:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if "header" in record:
+                header = record["header"]
+            else:
+                datasets.append(record)
+
+    if header is None:
+        raise ValueError("Incomplete index, the header line is missing: %s" % file_path)
+    header["datasets"] = datasets
+    return header
+
+
+def save_index(jdata, file_path, default=None):
+    """
+    Saves an index as JSON or, depending on the extension of `file_path`, in the columnar numpy format (`.npz`)
+    or as newline delimited JSON (`.ndjson`).
+    """
+    if is_npz_index(file_path):
+        save_npz_index(jdata, file_path, default)
+    elif is_ndjson_index(file_path):
+        writer = NdjsonIndexWriter(file_path, default)
+        for ds in jdata["datasets"]:
+            writer.write_dataset(ds)
+        writer.close({key: value for key, value in jdata.items() if key != "datasets"})
+    else:
+        write_file(json.dumps(jdata, default=_json_default(default)), file_path, "w")
+
+
+def dataset_attributes(jdata, ds):
+    """
+    Returns the global attributes of a dataset entry, which are shared between datasets in `attribute_sets`.
+    """
+    if "attributes" in ds:
+        return ds["attributes"]
+    return jdata.get("attribute_sets", {}).get(ds.get("attributes_id"))
+
+
+def load_index(file_path):
+    if is_npz_index(file_path):
+        return load_npz_index(file_path)
+    if is_ndjson_index(file_path):
+        return load_ndjson_index(file_path)
+    return json.loads(read_file(file_path, "r"))
@@ -1,14 +1,32 @@
+import asyncio
 import concurrent.futures
+import datetime
+import fnmatch
+import io
 import logging
+import pickle
 import re
+from collections import OrderedDict
+from functools import partial
 from typing import List
 
+import numpy
+from lxml import etree
+
+from data.dods_parser import parse_dods_array
 from data.model import catalog_from_xml_data
-from data.provider import CachedOrRemoteProvider
+from data.provider import CachedOrRemoteProvider, ProviderError, DEFAULT_MAX_RETRIES
 from data.ncml_parser import parse_ncml_file
+from data.parsed_cache import ParsedCache
+from util import read_file, write_file_atomic
 
 logger = logging.getLogger("opendapViz")
 
+DEFAULT_CONCURRENCY = 8
+DEFAULT_CHECKPOINT_INTERVAL = 500
+# Bump whenever the checkpoint content changes, older checkpoints are then ignored.
+CHECKPOINT_VERSION = 2
+
 
 class Filter:
     def test(self, to_test: str, **kwargs) -> bool:
@@ -22,10 +40,16 @@ class Filter:
         raise NotImplementedError("Must be implemented")
 
 
+def _glob_to_regex(pattern):
+    # globs match the whole name, `*` also matches `/`
+    return "^" + fnmatch.translate(pattern)
+
+
 class Exclude(Filter):
 
-    def __init__(self, to_ignore):
-        self._ignore_regex = re.compile(to_ignore)
+    def __init__(self, to_ignore, glob=False):
+        self.pattern = _glob_to_regex(to_ignore) if glob else to_ignore
+        self._ignore_regex = re.compile(self.pattern)
 
     def test(self, to_test: str, **kwargs) -> bool:
         return not bool(self._ignore_regex.search(to_test))
@@ -33,118 +57,460 @@ class Exclude(Filter):
 
 class Include(Filter):
 
-    def __init__(self, to_ignore):
-        self._ignore_regex = re.compile(to_ignore)
+    def __init__(self, to_ignore, glob=False):
+        self.pattern = _glob_to_regex(to_ignore) if glob else to_ignore
+        self._ignore_regex = re.compile(self.pattern)
 
     def test(self, to_test: str, **kwargs) -> bool:
         return bool(self._ignore_regex.search(to_test))
 
 
+class DateRange(Filter):
+    """
+    Passes names whose last date, written as `YYYYMMDD` or `YYYY-MM-DD`, lies between `start` and `end` (both
+    inclusive and optional).
+
+    :param start: `datetime.date` or string in one of the formats above
+    :param keep_undated: result for names without a date
+    """
+    _date_regex = re.compile(r"(?<!\d)(\d{4})-?(\d{2})-?(\d{2})")
+
+    def __init__(self, start=None, end=None, keep_undated=True):
+        self.start = self.to_date(start)
+        self.end = self.to_date(end)
+        self.keep_undated = keep_undated
+
+    @classmethod
+    def to_date(cls, value):
+        """
+        :param value: `datetime.date`, string in one of the formats above or None
+        :raise ValueError: if `value` contains no date
+        """
+        if value is None or isinstance(value, datetime.date):
+            return value
+        date = cls._last_date(value)
+        if date is None:
+            raise ValueError("Not a date: %s" % value)
+        return date
+
+    @classmethod
+    def _last_date(cls, name):
+        for match in reversed(cls._date_regex.findall(name)):
+            try:
+                return datetime.date(*map(int, match))
+            except ValueError:
+                # digits which are not a date, e.g. an invalid month
+                pass
+        return None
+
+    def test(self, to_test: str, **kwargs) -> bool:
+        date = self._last_date(to_test)
+        if date is None:
+            return self.keep_undated
+        return (self.start is None or self.start <= date) and (self.end is None or date <= self.end)
+
+
+class CombinedFilter(Filter):
+    """
+    Passes if all `filters` pass, like testing them one by one. The patterns of `Include` and `Exclude` filters
+    are compiled into one regex each: all includes as lookaheads, all excludes as one alternation. Other filters
+    and patterns which can not be combined, e.g. with back references, named groups or inline flags, are tested
+    separately.
+    """
+    # named groups clash when two patterns use the same name
+    _not_combinable = re.compile(r"\\[1-9]|\(\?P[=<]|\(\?[aiLmsux]+\)")
+
+    def __init__(self, filters: List[Filter]):
+        includes = []
+        excludes = []
+        self._separate = []
+        for f in filters:
+            if type(f) is Include and not self._not_combinable.search(f.pattern):
+                includes.append(f.pattern)
+            elif type(f) is Exclude and not self._not_combinable.search(f.pattern):
+                excludes.append(f.pattern)
+            else:
+                self._separate.append(f)
+
+        # `match` at the start with `.*?` lookaheads is equivalent to a `search` per pattern
+        self._include = re.compile("".join(r"(?=[\s\S]*?(?:%s))" % p for p in includes)) if includes else None
+        self._exclude = re.compile("|".join("(?:%s)" % p for p in excludes)) if excludes else None
+
+    def test(self, to_test: str, **kwargs) -> bool:
+        if self._exclude is not None and self._exclude.search(to_test):
+            return False
+        if self._include is not None and not self._include.match(to_test):
+            return False
+        return all(f.test(to_test, **kwargs) for f in self._separate)
+
+
 class Loader:
 
-    def __init__(self, cache_dir, base_url, catalog_url_part):
+    def __init__(self, cache_dir, base_url, catalog_url_part, concurrency=DEFAULT_CONCURRENCY, pool_size=None,
+                 revalidate=False, parsed_cache=True, cache_backend=None, compression="none",
+                 max_retries=DEFAULT_MAX_RETRIES, max_in_flight=None, checkpoint_file=None,
+                 checkpoint_interval=DEFAULT_CHECKPOINT_INTERVAL):
         self.catalog_url_part = catalog_url_part
-        self.provider = CachedOrRemoteProvider(cache_dir, base_url)
+        self.provider = CachedOrRemoteProvider(cache_dir, base_url, pool_size=pool_size or concurrency,
+                                               revalidate=revalidate, cache_backend=cache_backend,
+                                               compression=compression, max_retries=max_retries,
+                                               max_in_flight=max_in_flight)
+        self.parsed_cache = None
+        if parsed_cache:
+            # parse results are stored next to the raw responses
+            self.parsed_cache = ParsedCache(cache_dir, backend=self.provider.cached_provider.backend)
+        self.concurrency = concurrency
         self.catalog_base_uri = ""
         self._catalog_filters = []
         self._dataset_filters = []
-        self._catalog_refs_to_load = []
-        self._dataset_metas_to_load = []
+        self._catalog_filter = None
+        self._dataset_filter = None
+        self._crawl_queue = None
+        self._crawl_error = None
+        self._crawl_steps = {"catalog": (self._load_catalog, self._on_catalog_loaded),
+                             "dataset_meta": (self._load_dataset_meta, self._on_dataset_meta_loaded)}
+        self.checkpoint_file = checkpoint_file
+        self.checkpoint_interval = checkpoint_interval
+        # checkpoint records not written yet, and the single thread appending them to `checkpoint_file`
+        self._journal_records = []
+        self._journal_executor = None
+        self.root_catalog = None
         self.loaded_catalogs = []
         self.loaded_dataset_metas = []
+        # requests that still failed after all retries, the crawl continues without them
+        self.failures = []
+        # called with each loaded `DatasetInfo` instead of keeping it in `loaded_dataset_metas`. It runs on a crawl
+        # thread and may block to slow the crawl down. Only the root catalog is kept then.
+        self.dataset_meta_consumer = None
         self.opendap_base_url = ""
+        self.ncml_base_url = None
+
+    def _load_and_parse(self, kind, uri, parse_func, *args):
+        raw = self.provider.get_str_data(uri)
+        try:
+            if self.parsed_cache is None:
+                return parse_func(raw, *args)
+            return self.parsed_cache.get_or_parse(kind, raw, parse_func, *args)
+        except Exception:
+            # e.g. a truncated response, which must not be served from the cache again
+            self.provider.invalidate(uri)
+            raise
+
+    def _item_url(self, step, args):
+        """
+        :return: url requested by a crawl item, None if it can not be loaded
+        """
+        if step == "catalog":
+            return self.catalog_url_part + self.catalog_base_uri + args[0]
+        dataset_uri, ncml_base_url = args
+        return ncml_base_url + dataset_uri if ncml_base_url is not None else None
 
     def _load_catalog(self, catalog_uri):
         logger.debug("Loading catalog: %s" % catalog_uri)
-        catalog = catalog_from_xml_data(
-            self.provider.get_xml_data(self.catalog_url_part + self.catalog_base_uri + catalog_uri))
-        self._apply_filters(self._catalog_filters, catalog.catalog_refs, "id", self._queue_catalog_refs_to_load)
-        self._apply_filters(self._dataset_filters, catalog.datasets, "id", self._queue_datasets_to_load)
+        return self._load_and_parse("catalog", self._item_url("catalog", (catalog_uri,)), catalog_from_xml_data)
+
+    def _keep_catalog(self, catalog):
+        if self.root_catalog is None:
+            self.root_catalog = catalog
+        elif self.dataset_meta_consumer is None:
+            # when streaming, memory must not grow with the number of catalogs either
+            self.loaded_catalogs.append(catalog)
 
         self.ncml_base_url = catalog.ncml_base_url
         if catalog.opendap_base_url is not None:
             self.opendap_base_url = catalog.opendap_base_url
 
-        self._load_queued_catalog_refs()
-        self._load_queued_dataset_metas()
-        return catalog
+    def _on_catalog_loaded(self, catalog):
+        self._keep_catalog(catalog)
+        # datasets are queued together with the ncml endpoint of the catalog they were found in
+        self._apply_filters(self._catalog_filter, catalog.catalog_refs, "id", self._queue_catalog_refs_to_load)
+        self._apply_filters(self._dataset_filter, catalog.datasets, "id",
+                            partial(self._queue_datasets_to_load, ncml_base_url=catalog.ncml_base_url))
+
+    def _on_dataset_meta_loaded(self, dsi):
+        if self.dataset_meta_consumer is not None:
+            self.dataset_meta_consumer(dsi)
+        else:
+            self.loaded_dataset_metas.append(dsi)
+
+    def add_failure(self, step, uri, error):
+        logger.error("Skipping %s %s: %s" % (step, uri, error))
+        self.failures.append({"step": step, "uri": uri, "error": str(error)})
+
+    def retry_report(self):
+        """
+        :return: the failed requests and the number of retries per host
+        """
+        return {"failures": self.failures, "retries": dict(self.provider.remote_provider.retries)}
+
+    def load_opendap_array(self, uri, variable, count):
+        """
+        Loads the first `count` values of a one dimensional variable. The binary `.dods` representation is
+        decoded in one go, the `.ascii` representation is only used if it can not be decoded. Failed requests are
+        not repeated as `.ascii`, the retries of the provider are already spent.
+
+        :return: numpy array of the values
+        """
+        query = "?%s[0:1:%d]" % (variable, count - 1)
+        dods_uri = self.opendap_base_url + uri + ".dods" + query
+        content = self.provider.get_str_data(dods_uri)
+        try:
+            return parse_dods_array(content)
+        except ValueError as e:
+            self.provider.invalidate(dods_uri)
+            logger.warning("Binary response can not be decoded for %s, falling back to ascii: %s" % (uri, e))
+
+        ascii_uri = self.opendap_base_url + uri + ".ascii" + query
+        data = self.provider.get_str_data(ascii_uri)
+        try:
+            # Probably not the most stable way...
+            parts = data.decode("utf-8").strip().split("\n")
+            values = numpy.array(parts[-1].split(","), dtype=numpy.float64)
+            if len(values) != count:
+                raise ValueError("Expected %d values, got %d" % (count, len(values)))
+            return values
+        except ValueError:
+            # e.g. a truncated response, which must not be served from the cache again
+            self.provider.invalidate(ascii_uri)
+            raise
 
     def load_opendap_data(self, uri, variable, count, parse_values=lambda x: x):
-        data = self.provider.get_str_data(
-            self.opendap_base_url + uri + ".ascii?%s[0:1:%d]" % (variable, count - 1)).decode("utf-8")
-        # Probably not the most stable way...
-        parts = data.strip().split("\n")
-        values = parts[-1].split(",")
+        values = self.load_opendap_array(uri, variable, count).tolist()
         if parse_values is not None:
             return tuple(map(parse_values, values))
         return values
 
-    def _load_dataset_meta(self, dataset_uri):
-        if self.ncml_base_url is not None:
-            ncml_url = self.ncml_base_url + dataset_uri
+    def _load_dataset_meta(self, dataset_uri, ncml_base_url=None):
+        if ncml_base_url is not None:
+            ncml_url = self._item_url("dataset_meta", (dataset_uri, ncml_base_url))
             logger.debug("Loading dataset meta: %s" % ncml_url)
-            return parse_ncml_file(self.provider.get_xml_data(ncml_url), dataset_uri)
+            return self._load_and_parse("ncml", ncml_url, parse_ncml_file, dataset_uri)
         else:
            raise NotImplementedError("NCML service endpoint required.")
 
-    def _apply_filters(self, filters, iterable, attr_name, on_success):
-        if len(filters) == 0:
+    def _apply_filters(self, combined_filter: Filter, iterable, attr_name, on_success):
+        if combined_filter is None:
             rem = iterable[:]
         else:
-            rem = list(
-                filter(lambda item: all(map(lambda filter: filter.test(getattr(item, attr_name), item=item), filters)),
-                       iterable))
+            rem = [item for item in iterable if combined_filter.test(getattr(item, attr_name), item=item)]
         logger.debug("Filter result: %d/%d" % (len(rem), len(iterable)))
         on_success(rem)
 
     def add_filter(self, f: Filter, type="dataset"):
         if type in ("both", "dataset"):
             self._dataset_filters.append(f)
+            self._dataset_filter = CombinedFilter(self._dataset_filters)
         if type in ("both", "catalog"):
             self._catalog_filters.append(f)
+            self._catalog_filter = CombinedFilter(self._catalog_filters)
 
-    def load_catalog_recursively(self, base_uri, uri):
-        self.catalog_base_uri = base_uri
-        return self._load_catalog(uri)
-
-    def _queue_catalog_refs_to_load(self, refs: List):
-        logger.debug("Queued: %d catalogs" % len(refs))
-        self._catalog_refs_to_load = refs
+    def close(self):
+        """
+        Writes buffered cache data, e.g. the sharded cache index or uncommitted SQLite entries.
+        """
+        self.provider.close()
 
-    def _queue_datasets_to_load(self, ds):
-        logger.debug("Queued: %d datasets" % len(ds))
-        self._dataset_metas_to_load = ds
+    def __enter__(self):
+        return self
 
-    def _load_queued_catalog_refs(self):
-        refs = self._catalog_refs_to_load[:]
+    def __exit__(self, *exc_info):
+        self.close()
 
-        with concurrent.futures.ThreadPoolExecutor(max_workers=3) as executor:
-            future_to_url = {executor.submit(self._load_catalog, ref.href): ref.href for ref in refs}
-            results = self._handle_future_result(future_to_url)
+    def load_catalog_recursively(self, base_uri, uri, resume=False):
+        """
+        Crawls the catalog tree below `uri` breadth-first. Catalogs and dataset metas are fetched as soon as they
+        are discovered, with at most `concurrency` requests in flight for the whole crawl.
 
-        self._catalog_refs_to_load.clear()
-        self.loaded_catalogs.extend(results)
+        If a `checkpoint_file` is set, queued, loaded and failed items are appended to it in batches of
+        `checkpoint_interval` records and when the crawl ends, see `_restore_checkpoint`.
 
-    def _load_queued_dataset_metas(self, ):
-        ds_to_load = self._dataset_metas_to_load[:]
+        :param base_uri: catalog folder prefix, e.g. `polstracc0new/`
+        :param uri: root catalog relative to `base_uri`, e.g. `catalog.xml`
+        :param resume: continue the crawl saved in `checkpoint_file`, failed items are retried
+        :return: the root `CatalogInfo`
+        """
+        self.catalog_base_uri = base_uri
+        loop = asyncio.new_event_loop()
+        crawl = loop.create_task(self._crawl(uri, resume))
+        try:
+            loop.run_until_complete(crawl)
+        except BaseException:
+            # e.g. interrupted, let the requests in flight finish before the cache is closed
+            crawl.cancel()
+            loop.run_until_complete(asyncio.gather(crawl, return_exceptions=True))
+            raise
+        finally:
+            loop.close()
+        return self.root_catalog
+
+    def _journal(self, *record):
+        if self.checkpoint_file is not None:
+            self._journal_records.append(record)
+
+    def _append_journal(self, records):
+        content = b"".join(pickle.dumps(record, pickle.HIGHEST_PROTOCOL) for record in records)
+        try:
+            with open(self.checkpoint_file, "ab") as file:
+                file.write(content)
+        except OSError as e:
+            logger.error("Failed to save checkpoint %s: %s" % (self.checkpoint_file, e))
+            return
+        logger.debug("Checkpoint saved: %d new records" % len(records))
+
+    def _flush_journal(self, loop):
+        """
+        Appends the buffered records in the background, in order, without blocking the event loop.
+        """
+        if not self._journal_records:
+            return None
+        records, self._journal_records = self._journal_records, []
+        return loop.run_in_executor(self._journal_executor, self._append_journal, records)
 
-        with concurrent.futures.ThreadPoolExecutor(max_workers=3) as executor:
-            future_to_url = {executor.submit(self._load_dataset_meta, ds.url_path): ds.url_path for ds in ds_to_load}
-            results = self._handle_future_result(future_to_url)
+    def _start_checkpoint(self, catalog_uri):
+        write_file_atomic(pickle.dumps(("crawl", CHECKPOINT_VERSION, (self.catalog_base_uri, catalog_uri)),
+                                       pickle.HIGHEST_PROTOCOL), self.checkpoint_file, "wb")
 
-        self._dataset_metas_to_load.clear()
-        self.loaded_dataset_metas.extend(results)
+    def _restore_checkpoint(self, catalog_uri):
+        """
+        Replays the checkpoint journal: a header followed by `queued`, `done` (with the loaded result) and `failed`
+        records. Items queued but not done are pending again, as are failed items, whose cached responses are
+        dropped so they are requested again. An incomplete last record, e.g. of a killed run, is cut off.
 
-    def _handle_future_result(self, future_to_url):
-        results = []
-        for future in concurrent.futures.as_completed(future_to_url):
-            url = future_to_url[future]
+        :return: the pending (step, args) items, or None if there is no checkpoint of this crawl
+        """
+        content = read_file(self.checkpoint_file, "rb") if self.checkpoint_file is not None else None
+        if content is None:
+            logger.warning("No checkpoint to resume from, starting a new crawl")
+            return None
+
+        stream = io.BytesIO(content)
+        try:
+            header = pickle.load(stream)
+        except Exception as e:
+            logger.warning("Ignoring broken checkpoint %s: %s" % (self.checkpoint_file, e))
+            return None
+        if header != ("crawl", CHECKPOINT_VERSION, (self.catalog_base_uri, catalog_uri)):
+            logger.warning("Checkpoint %s belongs to a different crawl, starting a new crawl" % self.checkpoint_file)
+            return None
+
+        pending = OrderedDict()
+        failed = OrderedDict()
+        valid_size = stream.tell()
+        while valid_size < len(content):
+            try:
+                kind, step, args, *result = pickle.load(stream)
+            except Exception as e:
+                logger.warning("Ignoring the incomplete end of checkpoint %s: %s" % (self.checkpoint_file, e))
+                with open(self.checkpoint_file, "r+b") as file:
+                    file.truncate(valid_size)
+                break
+            valid_size = stream.tell()
+
+            item = (step, args)
+            if kind == "queued":
+                pending[item] = True
+            elif kind == "failed":
+                pending.pop(item, None)
+                failed[item] = True
+            elif kind == "done":
+                pending.pop(item, None)
+                failed.pop(item, None)
+                if step == "catalog":
+                    self._keep_catalog(result[0])
+                else:
+                    self._on_dataset_meta_loaded(result[0])
+
+        for step, args in failed:
+            url = self._item_url(step, args)
+            if url is not None:
+                self.provider.invalidate(url)
+        pending.update(failed)
+        logger.info("Resuming crawl: %d catalogs and %d datasets loaded, %d items pending (%d failed before)" % (
+            len(self.loaded_catalogs) + (self.root_catalog is not None), len(self.loaded_dataset_metas),
+            len(pending), len(failed)))
+        return list(pending)
+
+    async def _crawl(self, catalog_uri, resume=False):
+        self._crawl_queue = asyncio.Queue()
+        self._crawl_error = None
+        self._journal_records = []
+        pending = self._restore_checkpoint(catalog_uri) if resume else None
+        if pending is not None:
+            for item in pending:
+                self._crawl_queue.put_nowait(item)
+        else:
+            if self.checkpoint_file is not None:
+                self._start_checkpoint(catalog_uri)
+            self._queue("catalog", (catalog_uri,))
+
+        loop = asyncio.get_event_loop()
+        self._journal_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+                workers = [asyncio.ensure_future(self._crawl_worker(executor)) for _ in range(self.concurrency)]
+                try:
+                    await self._crawl_queue.join()
+                finally:
+                    for worker in workers:
+                        worker.cancel()
+                    await asyncio.gather(*workers, return_exceptions=True)
+        finally:
+            # also when interrupted, so the crawl can be resumed from here
+            flushed = self._flush_journal(loop)
+            if flushed is not None:
+                await flushed
+            self._journal_executor.shutdown(wait=True)
+            self._journal_executor = None
+
+        self._crawl_queue = None
+        if self._crawl_error is not None:
+            raise self._crawl_error
+
+    async def _crawl_worker(self, executor):
+        loop = asyncio.get_event_loop()
+        while True:
+            step, args = await self._crawl_queue.get()
+            load_func, on_loaded = self._crawl_steps[step]
             try:
-                data = future.result()
+                # after the first error the remaining queue is only drained
+                if self._crawl_error is None:
+                    try:
+                        result = await loop.run_in_executor(executor, load_func, *args)
+                    except (ProviderError, etree.XMLSyntaxError) as exc:
+                        # failed requests and truncated responses only lose this part of the tree
+                        self.add_failure(load_func.__name__.lstrip("_"), args[0], exc)
+                        self._journal("failed", step, args)
+                    else:
+                        if step == "dataset_meta" and self.dataset_meta_consumer is not None:
+                            # the consumer may wait for room in its queue, which must not stall the event loop
+                            await loop.run_in_executor(executor, self.dataset_meta_consumer, result)
+                        else:
+                            # the items queued by `on_loaded` are recorded before this one is done
+                            on_loaded(result)
+                        self._journal("done", step, args, result)
+
+                    if len(self._journal_records) >= self.checkpoint_interval:
+                        self._flush_journal(loop)
+            except asyncio.CancelledError:
+                # an `Exception` before Python 3.8, the worker must stop instead of waiting for the next item
+                raise
             except Exception as exc:
-                #logger.exception('%r generated an exception' % (url), exc)
-                raise exc
-            else:
-                results.append(data)
+                logger.error("%r generated an exception: %s" % (args[0], exc))
+                if self._crawl_error is None:
+                    self._crawl_error = exc
+            finally:
+                self._crawl_queue.task_done()
+
+    def _queue(self, step, args):
+        self._journal("queued", step, args)
+        self._crawl_queue.put_nowait((step, args))
+
+    def _queue_catalog_refs_to_load(self, refs: List):
+        logger.debug("Queued: %d catalogs" % len(refs))
+        for ref in refs:
+            self._queue("catalog", (ref.href,))
 
-        return results
+    def _queue_datasets_to_load(self, ds, ncml_base_url=None):
+        logger.debug("Queued: %d datasets" % len(ds))
+        for dataset in ds:
+            self._queue("dataset_meta", (dataset.url_path, ncml_base_url))
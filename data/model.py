@@ -1,20 +1,35 @@
+import concurrent.futures
+import hashlib
 import json
 import logging
 import re
-from functools import partial
-from typing import List, Dict, Callable
+import threading
+from collections import OrderedDict
+from typing import List, Dict, Callable, Iterable
 
+import numpy
 from lxml import etree
 from xarray import Dataset
 from xarray.core.utils import decode_numpy_dict_values, ensure_us_time_resolution
 
-from util import write_file, DotDict
+from data.index_io import NdjsonIndexWriter, load_index, save_index
+from data.provider import ProviderError
+from util import DotDict
 
 logger = logging.getLogger("opendapViz")
 
 
+def json_hash(jdata):
+    return hashlib.sha1(json.dumps(jdata, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+XLINK_NAMESPACE = "http://www.w3.org/1999/xlink"
+
+
 def dataset_info_from_xml_element(ns, xml_element: etree.ElementTree, parent=None):
-    parent = parent
+    """
+    Creates the `XMLDatasetInfo` of a single dataset element. Children are added by `catalog_from_xml_data`.
+    """
     name = xml_element.get("name")
     id = xml_element.get("ID")
     if id is None:
@@ -25,48 +40,69 @@ def dataset_info_from_xml_element(ns, xml_element: etree.ElementTree, parent=Non
     if size_element is not None:
         size = size_element.text + size_element.get("units")
 
-    dsi = XMLDatasetInfo(id, name, parent, url_path, size)
-    child_xml_elements = xml_element.findall('.//{%s}dataset' % ns)
-    dsi.children = list(map(lambda child: dataset_info_from_xml_element(ns, child, dsi), child_xml_elements))
-    return dsi
+    return XMLDatasetInfo(id, name, parent, url_path, size)
 
 
 def parse_catalog_ref(element: etree.ElementTree):
-    xlink_ns = element.nsmap.get("xlink")
-    href = element.get("{%s}href" % xlink_ns)
-    title = element.get("{%s}title" % xlink_ns)
+    href = element.get("{%s}href" % XLINK_NAMESPACE)
+    title = element.get("{%s}title" % XLINK_NAMESPACE)
     id = element.get("ID")
     if id is None:
         id = title
     return DotDict(href=href, title=title, id=id)
 
 
+def _walk_datasets(ns, xml_element, parent, datasets, refs):
+    # datasets and catalog refs in document order, as found by `.//dataset` and `.//catalogRef`
+    dataset_tag = "{%s}dataset" % ns
+    catalog_ref_tag = "{%s}catalogRef" % ns
+    for child in xml_element.iterchildren(dataset_tag, catalog_ref_tag):
+        if child.tag == catalog_ref_tag:
+            refs.append(parse_catalog_ref(child))
+            continue
+
+        dsi = dataset_info_from_xml_element(ns, child, parent)
+        if parent is not None:
+            parent.children.append(dsi)
+        datasets.append(dsi)
+        _walk_datasets(ns, child, dsi, datasets, refs)
+
+
 def catalog_from_xml_data(data):
+    """
+    Parses a THREDDS catalog in a single traversal. `datasets` lists all datasets below the top level dataset in
+    document order, each linked to its enclosing dataset by `parent` and to the datasets directly inside it by
+    `children`. Datasets directly below the top level dataset have no parent.
+
+    :param data: xml string or bytes, or etree Element
+    """
     if isinstance(data, str):
+        # lxml rejects strings with an encoding declaration
+        xml_element = etree.fromstring(data.encode("utf-8"))
+    elif isinstance(data, bytes):
         xml_element = etree.fromstring(data)
-    xml_element = data
+    else:
+        xml_element = data
     _ns = xml_element.nsmap.get(None, "")
     # logger.debug("Using XML namespace: %s", ns)
-    opendap_service = xml_element.find('.//{%s}service[@serviceType="OPENDAP"]' % _ns)
-    ncml_service = xml_element.find('.//{%s}service[@serviceType="NCML"]' % _ns)
     opendap_base_url = None
-    if opendap_service is not None:
-        opendap_base_url = opendap_service.get("base")
     ncml_base_url = None
-    if ncml_service is not None:
-        # if ncml_service is not None:
-        ncml_base_url = ncml_service.get("base")
+    service_tag = "{%s}service" % _ns
+    for service in xml_element.iterchildren(service_tag):
+        # compound services contain the actual ones
+        for service in service.iter(service_tag):
+            if service.get("serviceType") == "OPENDAP" and opendap_base_url is None:
+                opendap_base_url = service.get("base")
+            elif service.get("serviceType") == "NCML" and ncml_base_url is None:
+                ncml_base_url = service.get("base")
 
     # According to the XSD this is a mandatory field ?!
     base_dataset_element = xml_element.find('{%s}dataset' % _ns)
     name = base_dataset_element.get("name")
-    catalog_refs = base_dataset_element.findall('.//{%s}catalogRef' % _ns)
-    dataset_elements = base_dataset_element.findall('.//{%s}dataset' % _ns)
 
-    datasets = list(map(partial(dataset_info_from_xml_element, _ns), dataset_elements))
-    refs = list(map(parse_catalog_ref, catalog_refs))
-    # get all datasets and sub-catalog catalogRef-s
-    dataset = dataset_info_from_xml_element(_ns, base_dataset_element, None)
+    datasets = []
+    refs = []
+    _walk_datasets(_ns, base_dataset_element, None, datasets, refs)
     return CatalogInfo(name, datasets, refs, opendap_base_url, ncml_base_url)
 
 
@@ -167,6 +203,8 @@ class DatasetMeta(object):
         self.dimensions = dims
         self.attributes = attrs
         self.variables = vars
+        self._signature = None
+        self._fingerprint = None
 
     def toJson(self):
         return {
@@ -174,6 +212,31 @@ class DatasetMeta(object):
             "variables": self.variables,
             "attributes": self.attributes}
 
+    @staticmethod
+    def fromJson(jdata):
+        variables = {name: DotDict(var) for name, var in jdata.get("variables", {}).items()}
+        return DatasetMeta(jdata.get("attributes", {}), jdata.get("dimensions", {}), variables)
+
+    def signature(self):
+        """
+        Hash over dimensions (including their lengths), variables and attributes. Datasets with an unchanged
+        signature do not need their coordinates to be retrieved again.
+        """
+        if self._signature is None:
+            self._signature = json_hash(self.toJson())
+        return self._signature
+
+    def fingerprint(self):
+        """
+        Hash over what `__eq__` compares: dimension names and the type and dimensions of each variable. Metas with
+        the same fingerprint are equal.
+        """
+        if self._fingerprint is None:
+            self._fingerprint = json_hash({
+                "dimensions": sorted(self.dimensions),
+                "variables": {name: [var.type, sorted(set(var.shape))] for name, var in self.variables.items()}})
+        return self._fingerprint
+
     @staticmethod
     def mismatched_dimensions(dims1, dims2):
         return set(dims1) ^ set(dims2)
@@ -245,43 +308,239 @@ class MetaInformationMismatchError(Exception):
     pass
 
 
+def _json_default(o):
+    return o.toJson() if hasattr(o, "toJson") else o.__dict__
+
+
 class DatasetsIndex:
+    """
+    Index of datasets sharing the same meta information.
+
+    :param coordinate_data_to_retrieve: maps dimension names to functions applied to the numpy array of the
+        dimension values, e.g. to format timestamps
+    :param multi_schema: instead of ignoring datasets whose meta information differs from the first dataset,
+        group them into schemas by `DatasetMeta.fingerprint`. `meta_information` is the schema of the first dataset.
+    """
 
-    def __init__(self, base_url: str, loader, coordinate_data_to_retrieve: Dict[str, Callable]):
+    def __init__(self, base_url: str, loader, coordinate_data_to_retrieve: Dict[str, Callable], multi_schema=False):
         self.base_url = base_url
         self.loader = loader
+        self.multi_schema = multi_schema
         self.meta_information = None
+        self.schemas = OrderedDict()
         self.datasets = []
         self.coordinate_data_to_retrieve = coordinate_data_to_retrieve
+        self._previous_datasets = OrderedDict()
+        self._ignored_ids = set()
+        self.attribute_sets = {}
+        self._stream = None
+
+    def load_previous(self, file_path):
+        """
+        Loads an existing index to update. Datasets with an unchanged id and meta signature reuse their stored
+        coordinates, and datasets not visited again are kept in the saved index.
+        """
+        jdata = load_index(file_path)
+        self.meta_information = DatasetMeta.fromJson(jdata["meta"])
+        self.schemas[self.meta_information.fingerprint()] = self.meta_information
+        for meta in jdata.get("schemas", {}).values():
+            meta = DatasetMeta.fromJson(meta)
+            self.schemas.setdefault(meta.fingerprint(), meta)
+        self._previous_datasets = OrderedDict((ds["id"], ds) for ds in jdata["datasets"])
+        self.attribute_sets.update(jdata.get("attribute_sets", {}))
+        for ds in self._previous_datasets.values():
+            # indexes written before attributes were shared embed them in every dataset
+            if "attributes" in ds:
+                ds["attributes_id"] = self._intern_attributes(ds.pop("attributes"))
+        logger.info("Updating index with %d datasets: %s" % (len(self._previous_datasets), file_path))
+
+    def _accept_dataset(self, dsi: DatasetInfo):
+        if self.multi_schema:
+            return self._accept_schema(dsi)
 
-    def add_dataset(self, dsi: DatasetInfo, keep_attributes=False):  # dsi: DatasetInfo,
         if self.meta_information is None:
             self.meta_information = dsi.meta
+            self.schemas[dsi.meta.fingerprint()] = dsi.meta
             for to_keep in self.coordinate_data_to_retrieve:
                 if to_keep not in dsi.meta.dimensions:
                     raise MetaInformationMismatchError("No such dimension to retrieve: " + to_keep)
 
         elif self.meta_information != dsi.meta:
             logger.info("Meta information mismatch! Ignoring dataset: " + dsi.id)
-            return
+            self._ignored_ids.add(dsi.id)
+            return False
+
+        return True
+
+    def _accept_schema(self, dsi: DatasetInfo):
+        fingerprint = dsi.meta.fingerprint()
+        if fingerprint not in self.schemas:
+            missing = [to_keep for to_keep in self.coordinate_data_to_retrieve if to_keep not in dsi.meta.dimensions]
+            if missing:
+                logger.info("No such dimension to retrieve: %s. Ignoring dataset: %s" % (", ".join(missing), dsi.id))
+                self._ignored_ids.add(dsi.id)
+                return False
 
-        data = {}
+            logger.info("New schema %s: %s" % (fingerprint, dsi.id))
+            self.schemas[fingerprint] = dsi.meta
+            if self.meta_information is None:
+                self.meta_information = dsi.meta
 
-        for to_keep in self.coordinate_data_to_retrieve:
-            dim_count = int(dsi.meta.dimensions[to_keep])
-            parse_func = self.coordinate_data_to_retrieve[to_keep]
-            data[to_keep] = self.loader.load_opendap_data(dsi.id, to_keep, dim_count, parse_func)
+        return True
+
+    def _dataset_info(self, dsi: DatasetInfo, keep_attributes=False):
+        signature = dsi.meta.signature()
+        previous = self._previous_datasets.get(dsi.id)
+        if previous is not None and previous.get("signature") == signature:
+            logger.debug("Unchanged dataset: %s" % dsi.id)
+            data = previous["data"]
+        else:
+            data = {}
+            for to_keep in self.coordinate_data_to_retrieve:
+                dim_count = int(dsi.meta.dimensions[to_keep])
+                parse_func = self.coordinate_data_to_retrieve[to_keep]
+                values = self.loader.load_opendap_array(dsi.id, to_keep, dim_count)
+                data[to_keep] = numpy.asarray(parse_func(values)).tolist()
 
-        info = {"id": dsi.id, "data": data}  # "name": dsi.name, "url_path": dsi.url_path,
+        info = {"id": dsi.id, "schema": dsi.meta.fingerprint(), "signature": signature,
+                "data": data}  # "name": dsi.name, "url_path": dsi.url_path,
         if keep_attributes:
-            info["attributes"] = dsi.meta.attributes
-        self.datasets.append(info)
+            info["attributes_id"] = self._intern_attributes(dsi.meta.attributes)
+        return info
 
-    def save(self, file_path):
-        def parse(o):
-            return o.toJson() if hasattr(o, "toJson") else o.__dict__
+    def _intern_attributes(self, attributes):
+        """
+        Stores each distinct set of global attributes once. Datasets reference it by `attributes_id`.
+        """
+        attributes_id = json_hash(attributes)
+        self.attribute_sets.setdefault(attributes_id, attributes)
+        return attributes_id
+
+    def add_dataset(self, dsi: DatasetInfo, keep_attributes=False):  # dsi: DatasetInfo,
+        if self._accept_dataset(dsi):
+            self.datasets.append(self._dataset_info(dsi, keep_attributes))
+
+    def add_datasets(self, dsis: Iterable[DatasetInfo], keep_attributes=False, max_workers=None):
+        """
+        Adds several datasets, retrieving their coordinates concurrently.
+
+        The meta information check runs in input order before any request is made, and the datasets are added in
+        input order regardless of which retrieval finishes first.
+
+        :param max_workers: maximum number of concurrent retrievals, defaults to the loader concurrency
+        """
+        accepted = list(filter(self._accept_dataset, dsis))
+        count = len(accepted)
+
+        def retrieve(i, dsi):
+            logger.debug("Entry %s: %d of %d" % (dsi.id, i, count))
+            return self._retrieve_dataset_info(dsi, keep_attributes)
 
-        jdata = json.dumps({"base_url": self.base_url, "opendap_url": self.base_url + self.loader.opendap_base_url,
-                            "meta": self.meta_information,
-                            "datasets": self.datasets}, default=parse)
-        write_file(jdata, file_path, "w")
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers or self.loader.concurrency) as executor:
+            self.datasets.extend(info for info in executor.map(retrieve, range(count), accepted) if info is not None)
+
+    def _retrieve_dataset_info(self, dsi: DatasetInfo, keep_attributes):
+        try:
+            return self._dataset_info(dsi, keep_attributes)
+        except ProviderError as e:
+            # previous data of the dataset, if any, is kept by `save`
+            self.loader.add_failure("load_opendap_array", dsi.id, e)
+            return None
+
+    def open_stream(self, file_path, keep_attributes=False, max_workers=None, max_pending=None):
+        """
+        Pipeline mode: datasets passed to `submit_dataset` are retrieved in the background and written to the
+        `.ndjson` index at `file_path` as soon as their coordinates are known, in the order they finish.
+        Only the ids of written datasets are kept in memory. Finish with `close_stream`.
+
+        :param max_pending: maximum number of datasets waiting for retrieval, `submit_dataset` blocks beyond
+        """
+        max_workers = max_workers or self.loader.concurrency
+        self._stream = DotDict(
+            writer=NdjsonIndexWriter(file_path, default=_json_default),
+            executor=concurrent.futures.ThreadPoolExecutor(max_workers=max_workers),
+            slots=threading.BoundedSemaphore(max_pending or 4 * max_workers),
+            keep_attributes=keep_attributes, lock=threading.Lock(), written_ids=set(), schemas=set(),
+            attributes_ids=set(), error=None)
+
+    def submit_dataset(self, dsi: DatasetInfo):
+        """
+        Blocks while `max_pending` datasets wait for retrieval, so call it from a worker thread, not an event loop.
+        Safe to call from several threads.
+        """
+        with self._stream.lock:
+            if not self._accept_dataset(dsi):
+                return
+        self._stream.slots.acquire()
+        future = self._stream.executor.submit(self._retrieve_dataset_info, dsi, self._stream.keep_attributes)
+        future.add_done_callback(self._on_dataset_retrieved)
+
+    def _on_dataset_retrieved(self, future):
+        try:
+            info = future.result()
+            if info is not None:
+                self._write_stream_entry(info)
+        except Exception as e:
+            logger.error("Failed to add dataset: %s" % e)
+            self._stream["error"] = self._stream.error or e
+        finally:
+            self._stream.slots.release()
+
+    def _write_stream_entry(self, ds):
+        self._stream.writer.write_dataset(ds)
+        with self._stream.lock:
+            self._stream.written_ids.add(ds["id"])
+            self._stream.schemas.add(ds["schema"])
+            if "attributes_id" in ds:
+                self._stream.attributes_ids.add(ds["attributes_id"])
+
+    def close_stream(self):
+        """
+        Waits for the pending retrievals, writes the datasets of the previous index which were not visited
+        again and finally the header line.
+        """
+        stream = self._stream
+        stream.executor.shutdown(wait=True)
+        default_schema = self.meta_information.fingerprint() if self.meta_information is not None else None
+        for ds_id, ds in self._previous_datasets.items():
+            if ds_id not in stream.written_ids and ds_id not in self._ignored_ids:
+                ds.setdefault("schema", default_schema)
+                self._write_stream_entry(ds)
+
+        stream.writer.close(self._header(stream.schemas, stream.attributes_ids))
+        self._stream = None
+        if stream.error is not None:
+            raise stream.error
+
+    def _merged_datasets(self):
+        # previous datasets keep their position, new datasets are appended
+        current = OrderedDict((ds["id"], ds) for ds in self.datasets)
+        merged = [current.pop(ds_id, ds) for ds_id, ds in self._previous_datasets.items()
+                  if ds_id not in self._ignored_ids]
+        merged.extend(current.values())
+        return merged
+
+    def _header(self, schemas, attributes_ids):
+        """
+        Everything of the saved index but the datasets.
+
+        :param schemas: fingerprints of the schemas used by the datasets
+        :param attributes_ids: attribute sets referenced by the datasets
+        """
+        default_schema = self.meta_information.fingerprint() if self.meta_information is not None else None
+        return {"base_url": self.base_url, "opendap_url": self.base_url + self.loader.opendap_base_url,
+                "meta": self.meta_information,
+                "default_schema": default_schema,
+                "schemas": OrderedDict((key, meta) for key, meta in self.schemas.items() if key in schemas),
+                "attribute_sets": {key: self.attribute_sets[key] for key in sorted(attributes_ids)}}
+
+    def save(self, file_path):
+        datasets = self._merged_datasets()
+        default_schema = self.meta_information.fingerprint() if self.meta_information is not None else None
+        for ds in datasets:
+            # entries of indexes written before schemas were introduced
+            ds.setdefault("schema", default_schema)
+        attributes_ids = set(ds["attributes_id"] for ds in datasets if "attributes_id" in ds)
+        jdata = self._header(set(ds["schema"] for ds in datasets), attributes_ids)
+        jdata["datasets"] = datasets
+        save_index(jdata, file_path, default=_json_default)
@@ -1,3 +1,4 @@
+import io
 import logging
 import os
 
@@ -10,81 +11,117 @@ from lxml import etree
 
 ncml_namespace = 'http://www.unidata.ucar.edu/namespaces/netcdf/ncml-2.2'
 
+_float_types = {'float', 'double'}
+_int_types = {'int', 'long', 'short'}
+
 
 def process_attribute_tag(target, a):
-    attr_name = a.attrib.get("name")
+    attr_name = a.get("name")
     if attr_name is None:
         logger.error("No 'name' attribute supplied on the <attribute /> tag.  Skipping.")
         return
 
-    tipe = a.attrib.get("type")
-    value = a.attrib.get("value")
+    tipe = a.get("type")
+    value = a.get("value")
 
     if value is not None:
         if tipe is not None:
-            if tipe.lower() in ['float', 'double']:
+            tipe = tipe.lower()
+            if tipe in _float_types:
                 value = float(value)
-            elif tipe.lower() in ['int', 'long', 'short']:
+            elif tipe in _int_types:
                 try:
                     value = int(value)
                 except Exception as ex:
                     logger.exception("Failed to parse value: ", ex)
-        logger.debug("Setting attribute '{0}' to '{1!s}''".format(attr_name, value))
 
     return attr_name, value
 
 
-def parse_ncml_file(ncml, id):
-    # Based on: https://github.com/axiom-data-science/pyncml
-    if isinstance(ncml, str) and os.path.isfile(ncml):
-        root = etree.parse(ncml).getroot()
+_variable_tag = '{%s}variable' % ncml_namespace
+_attribute_tag = '{%s}attribute' % ncml_namespace
+_dimension_tag = '{%s}dimension' % ncml_namespace
+_group_tag = '{%s}group' % ncml_namespace
+
+
+def _ncml_events(ncml):
+    """
+    Returns `(events, clear)`: end events of the document and whether processed elements may be cleared.
+    """
+    if isinstance(ncml, bytes):
+        return etree.iterparse(io.BytesIO(ncml), events=("end",)), True
+    elif isinstance(ncml, str) and os.path.isfile(ncml):
+        return etree.iterparse(ncml, events=("end",)), True
     elif isinstance(ncml, str):
-        root = etree.fromstring(ncml)
+        return etree.iterparse(io.BytesIO(ncml.encode("utf-8")), events=("end",)), True
     elif etree.iselement(ncml):
-        root = ncml
-    else:
-        raise ValueError("Could not parse ncml. \
-                         Did you pass in a valid file path, xml string, or etree Element object?")
+        # do not modify a tree owned by the caller
+        return etree.iterwalk(ncml, events=("end",)), False
+    raise ValueError("Could not parse ncml. \
+                     Did you pass in a valid file path, xml string, or etree Element object?")
+
+
+def _parse_attributes(element, target):
+    for a in element.iterchildren(_attribute_tag):
+        attribute = process_attribute_tag(target, a)
+        if attribute is not None:
+            target[attribute[0]] = {"value": attribute[1]}
+    return target
+
+
+def parse_ncml_file(ncml, id):
+    """
+    Parses the NcML document in a single streaming pass. Each child of the root element is processed as soon as
+    it is complete and then cleared.
+
+    :param ncml: file path, xml string or bytes, or etree Element
+    :param id: dataset id, used unless the THREDDSMetadata group provides one
+    """
+    # Based on: https://github.com/axiom-data-science/pyncml
+    events, clear = _ncml_events(ncml)
 
     global_attributes = {}
     dimensions = {}
     variables = {}
-    thredds_meta = {}
-    thredds_xml_meta = root.find('.//{%s}group[@name="THREDDSMetadata"]' % ncml_namespace)
-    if thredds_xml_meta is not None:
-        id = thredds_xml_meta.find('.//{%s}attribute[@name="id"]' % ncml_namespace).get("value")
-        od_service = thredds_xml_meta.find('.//{%s}attribute[@name="opendap_service"]' % ncml_namespace).get("value")
-        thredds_meta = {"opendap_url": od_service, "id": id}
-
-    # Variables
-    for v in root.findall('{%s}variable' % ncml_namespace):
-
-        var_name = v.attrib.get("name")
-        attributes = {}
-
-        for a in v.findall('{%s}attribute' % ncml_namespace):
-            name, value = process_attribute_tag(attributes, a)
-            attributes[name] = {"value": value}
-
-        shape = v.attrib.get("shape").split(" ")
-        variables[var_name] = DotDict(
-            {"type": v.attrib.get("type"), "shape": shape, "attributes": attributes})
-
-        # Global attributes
-    for a in root.findall('{%s}attribute' % ncml_namespace):
-        name, value = process_attribute_tag(global_attributes, a)
-        global_attributes[name] = {"value": value}
-
-    # Dimensions
-    for d in root.findall('{%s}dimension' % ncml_namespace):
-        dim_name = d.attrib.get('name')
-        dim_length = d.attrib.get("length")
-        dimensions[dim_name] = dim_length
-
-    """return DotDict(
-        {"variables": DotDict(variables), "dimensions": DotDict(dimensions), "attributes": DotDict(global_attributes),
-         "thredds_meta": DotDict(thredds_meta)})
-    """
+    thredds_meta = None
+    root = None
+
+    for _, element in events:
+        parent = element.getparent()
+        if root is None:
+            root = element.getroottree().getroot()
+        # only children of the root element are processed, their content is still complete at this point
+        if parent is not root:
+            continue
+
+        tag = element.tag
+        if tag == _variable_tag:
+            variables[element.get("name")] = DotDict(
+                {"type": element.get("type"), "shape": element.get("shape", "").split(" "),
+                 "attributes": _parse_attributes(element, {})})
+        elif tag == _attribute_tag:
+            attribute = process_attribute_tag(global_attributes, element)
+            if attribute is not None:
+                global_attributes[attribute[0]] = {"value": attribute[1]}
+        elif tag == _dimension_tag:
+            dimensions[element.get("name")] = element.get("length")
+        elif tag == _group_tag and thredds_meta is None:
+            for group in element.iter(_group_tag):
+                if group.get("name") == "THREDDSMetadata":
+                    thredds_meta = {}
+                    for a in group.iter(_attribute_tag):
+                        if a.get("name") in ("id", "opendap_service"):
+                            thredds_meta.setdefault(a.get("name"), a.get("value"))
+                    break
+
+        if clear:
+            element.clear()
+            while element.getprevious() is not None:
+                del parent[0]
+
+    if thredds_meta and "id" in thredds_meta:
+        id = thredds_meta["id"]
+
     meta = DatasetMeta(global_attributes, dimensions, variables)
     return DatasetInfo(id, meta)
 
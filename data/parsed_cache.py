@@ -0,0 +1,51 @@
+import hashlib
+import logging
+import pickle
+
+from data.cache_backend import CacheBackend, MirrorCacheBackend
+
+logger = logging.getLogger("opendapViz")
+
+# Bump whenever the output of the catalog or NcML parser changes, older entries are then ignored.
+PARSER_VERSION = 1
+
+
+class ParsedCache:
+    """
+    Second cache tier storing parse results, e.g. `CatalogInfo` and `DatasetInfo`, pickled under the hash of the
+    raw content they were parsed from. Changed raw data hashes differently, so stale entries are never used.
+
+    :param backend: storage of the entries, usually the one of the raw responses
+    """
+
+    def __init__(self, cache_dir, version=PARSER_VERSION, backend: CacheBackend = None):
+        self.backend = backend or MirrorCacheBackend(cache_dir)
+        self.prefix = ".parsed/v%d/" % version
+
+    def _entry_key(self, kind, raw: bytes, args):
+        content_hash = hashlib.sha1(raw)
+        # parse arguments, e.g. the fallback dataset id, are part of the key
+        content_hash.update(repr(args).encode("utf-8"))
+        key = content_hash.hexdigest()
+        return "%s%s/%s/%s.pickle" % (self.prefix, kind, key[:2], key)
+
+    def get_or_parse(self, kind, raw: bytes, parse_func, *args):
+        """
+        Returns the cached result of `parse_func(raw, *args)` or parses and caches it.
+
+        :param kind: name of the parser, e.g. `catalog` or `ncml`
+        """
+        key = self._entry_key(kind, raw, args)
+        content = self.backend.read(key)
+        if content is not None:
+            try:
+                return pickle.loads(content)
+            except Exception as e:
+                logger.warning("Ignoring broken parse cache entry %s: %s" % (key, e))
+
+        result = parse_func(raw, *args)
+        try:
+            self.backend.write(key, pickle.dumps(result, pickle.HIGHEST_PROTOCOL))
+        except Exception as e:
+            logger.warning("Failed to write parse cache entry %s: %s" % (key, e))
+        return result
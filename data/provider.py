@@ -1,21 +1,52 @@
+import email.utils
 import json
 import logging
+import random
+import threading
+import time
+from collections import Counter
 from pathlib import Path
 from typing import Union
-from urllib.error import URLError
-from urllib.request import Request, urlopen
+from urllib.error import HTTPError
 
+import urllib3
 from lxml import etree
 
-from util import write_file, read_file
+from data.cache_backend import CacheBackend, MirrorCacheBackend
+from data.compression import check_compression, compress, decompress, detect_compression
 
 logger = logging.getLogger("opendapViz")
 
+DEFAULT_POOL_SIZE = 8
+DEFAULT_MAX_RETRIES = 4
+VALIDATORS_EXT = ".validators.json"
+# answers worth retrying, 429 and 503 may tell how long to wait with `Retry-After`
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
 
 class ProviderError(Exception):
 
     def __init__(self, original_error, url):
+        super().__init__("%s: %s" % (url, original_error))
         self.original_error = original_error
+        self.url = url
+
+
+def parse_retry_after(value):
+    """
+    :param value: `Retry-After` header, either seconds or an HTTP date
+    :return: seconds to wait or None
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    date = email.utils.parsedate_tz(value)
+    if date is None:
+        return None
+    return max(0.0, email.utils.mktime_tz(date) - time.time())
 
 
 class Provider(object):
@@ -33,29 +64,46 @@ class Provider(object):
 
 
 class CachedProvider(Provider):
-
-    def __init__(self, cache_dir: str):
+    """
+    :param backend: storage of the cache entries, defaults to mirroring the remote paths below `cache_dir`
+    :param compression: `none`, `gzip` or `zstd`, used for newly saved responses. Compressed entries are detected
+        and decompressed on read regardless of this setting.
+    """
+
+    def __init__(self, cache_dir: str, backend: CacheBackend = None, compression="none"):
+        check_compression(compression)
         self.cache_dir = Path(cache_dir)
+        self.backend = backend or MirrorCacheBackend(cache_dir)
+        self.compression = compression
         self._get_catalog_data = self._read_cache_file
 
     def _read_cache_file(self, file_path: str, mode="rb") -> Union[str, bytes, None]:
         try:
-            file_path = file_path.lstrip("/")
-            return read_file(self.cache_dir / file_path, mode)
+            content = self.backend.read(file_path)
+            if content is not None:
+                content = decompress(content)
         except Exception as e:
             logger.exception("Failed to read file: %s", file_path)
             raise ProviderError(e, file_path)
 
+        if content is not None and "b" not in mode:
+            return content.decode("utf-8")
+        return content
+
     def _write_cache_file(self, file_path: str, content, mode="wb"):
         try:
-            file_path = file_path.lstrip("/")
-            write_file(content, self.cache_dir.joinpath(file_path), mode)
+            if isinstance(content, str):
+                content = content.encode("utf-8")
+            self.backend.write(file_path, content)
         except Exception as e:
-            logger.exception(e, "Failed to write file: %s", file_path)
+            logger.exception("Failed to write file: %s", file_path)
             raise ProviderError(e, file_path)
 
         return True
 
+    def close(self):
+        self.backend.close()
+
     def _get_raw_data(self, uri: str, **kwargs):
         mode = "r" + kwargs.get("mode_postfix", "")
         ext = kwargs.get("ext", "")
@@ -64,50 +112,219 @@ class CachedProvider(Provider):
     def _save_raw_data(self, file_path: str, content, **kwargs):
         mode = "w" + kwargs.get("mode_postfix", "")
         ext = kwargs.get("ext", "")
+        if isinstance(content, str):
+            content = content.encode("utf-8")
+        # content already compressed the right way, e.g. a gzip encoded response, is saved as is
+        if detect_compression(content) != self.compression:
+            content = compress(decompress(content), self.compression)
         self._write_cache_file(file_path + ext, content, mode)
 
+    def _delete_raw_data(self, uri: str, **kwargs):
+        """
+        Removes a cache entry and its validators.
+        """
+        ext = kwargs.get("ext", "")
+        for file_path in (uri + ext, uri + ext + VALIDATORS_EXT):
+            try:
+                self.backend.delete(file_path)
+            except Exception as e:
+                logger.exception("Failed to delete file: %s", file_path)
+                raise ProviderError(e, file_path)
+
+    def _get_validators(self, uri: str, **kwargs):
+        """
+        Returns the response validators (`etag`, `last_modified`, `fetched`) stored next to a cache entry or None.
+        """
+        ext = kwargs.get("ext", "")
+        content = self._read_cache_file(uri + ext + VALIDATORS_EXT, "r")
+        if content is None:
+            return None
+        return json.loads(content)
+
+    def _save_validators(self, uri: str, validators, **kwargs):
+        ext = kwargs.get("ext", "")
+        self._write_cache_file(uri + ext + VALIDATORS_EXT, json.dumps(validators), "w")
 
-class RemoteProvider(Provider):
 
-    def __init__(self, base_url):
+class RemoteProvider(Provider):
+    """
+    :param max_retries: retries of failed requests: connection errors, timeouts and `RETRY_STATUSES`. The delay
+        grows exponentially from `backoff` seconds up to `max_backoff`, with random jitter.
+    :param max_in_flight: maximum number of concurrent requests per host, defaults to `pool_size`
+    """
+
+    def __init__(self, base_url, pool_size=DEFAULT_POOL_SIZE, timeout=10, max_retries=DEFAULT_MAX_RETRIES,
+                 backoff=0.5, max_backoff=60.0, max_in_flight=None):
         self.base_url = base_url
+        # One keep-alive pool per host, shared by all threads using this provider. Blocking on an exhausted pool
+        # keeps the number of open connections at `pool_size` instead of opening throwaway connections.
+        # Retries are handled in `_open`, urllib3 only follows redirects.
+        retries = urllib3.Retry(connect=0, read=0, redirect=5, respect_retry_after_header=False)
+        self.pool = urllib3.PoolManager(maxsize=pool_size, block=True, timeout=timeout, retries=retries)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.max_in_flight = max_in_flight or pool_size
+        self._lock = threading.Lock()
+        self._host_limits = {}
+        # host -> time before which no request is sent, set by `Retry-After`
+        self._host_paused_until = {}
+        self.retries = Counter()
+
+    def _host_limit(self, host):
+        with self._lock:
+            if host not in self._host_limits:
+                self._host_limits[host] = threading.BoundedSemaphore(self.max_in_flight)
+            return self._host_limits[host]
+
+    def _wait_for_host(self, host):
+        with self._lock:
+            paused_until = self._host_paused_until.get(host, 0)
+        delay = paused_until - time.time()
+        if delay > 0:
+            time.sleep(delay)
+
+    def _backoff_delay(self, attempt, retry_after=None):
+        delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, self.max_backoff))
+        return delay
+
+    def _request_once(self, url, headers, decode_content):
+        """
+        :return: tuple of the response and, if the request should be retried, the error and the `Retry-After` delay
+        """
+        try:
+            result = self.pool.request("GET", url, headers=headers, decode_content=decode_content)
+        except urllib3.exceptions.HTTPError as e:
+            return None, ProviderError(e, url), None
 
-    @staticmethod
-    def request(url) -> bytes:
-        request = Request(url)
+        if result.status >= 400:
+            error = ProviderError(HTTPError(url, result.status, result.reason, result.headers, None), url)
+            if result.status not in RETRY_STATUSES:
+                logger.error("Failed to request url: %s (HTTP %d)", url, result.status)
+                raise error
+            return result, error, parse_retry_after(result.headers.get("Retry-After"))
 
-        logger.debug("Requesting: %s", url)
+        return result, None, None
 
-        try:
-            result = urlopen(request, timeout=10)
-            data = result.read()
-        except URLError as e:
-            logger.exception("Failed to request url: %s", url)
-            raise ProviderError(e, url)
-
-        return data
+    def _open(self, url, headers=None, decode_content=True):
+        logger.debug("Requesting: %s", url)
+        host = urllib3.util.parse_url(url).host
+
+        attempt = 0
+        while True:
+            self._wait_for_host(host)
+            with self._host_limit(host):
+                result, error, retry_after = self._request_once(url, headers, decode_content)
+            if error is None:
+                return result
+
+            if attempt >= self.max_retries:
+                logger.error("Failed to request url: %s after %d attempts: %s", url, attempt + 1,
+                             error.original_error)
+                raise error
+
+            delay = self._backoff_delay(attempt, retry_after)
+            if retry_after is not None:
+                # the server asked to slow down, hold back all requests to it
+                with self._lock:
+                    self._host_paused_until[host] = max(self._host_paused_until.get(host, 0), time.time() + delay)
+            with self._lock:
+                self.retries[host] += 1
+            logger.warning("Retrying %s in %.1f s (attempt %d of %d): %s", url, delay, attempt + 2,
+                           self.max_retries + 1, error.original_error)
+            time.sleep(delay)
+            attempt += 1
+
+    def request(self, url) -> bytes:
+        return self._open(url).data
 
     def _get_raw_data(self, uri, **kwargs):
         prefix = kwargs.get("prefix", "")
         return self.request(self.base_url + prefix + uri)
 
+    def _get_raw_response(self, uri, validators=None, **kwargs):
+        """
+        Conditional variant of `_get_raw_data`.
 
-class CachedOrRemoteProvider(Provider):
+        :param validators: validators of the cached copy, as returned by a previous call
+        :return: tuple of the response body and the new validators. The body is None if the server answered
+            `304 Not Modified`. It is returned as transferred, i.e. still gzip compressed if the server used
+            `Content-Encoding: gzip`.
+        """
+        prefix = kwargs.get("prefix", "")
+        headers = {"Accept-Encoding": "gzip"}
+        if validators:
+            if validators.get("etag"):
+                headers["If-None-Match"] = validators["etag"]
+            if validators.get("last_modified"):
+                headers["If-Modified-Since"] = validators["last_modified"]
+
+        result = self._open(self.base_url + prefix + uri, headers, decode_content=False)
+        new_validators = {"etag": result.headers.get("ETag"), "last_modified": result.headers.get("Last-Modified"),
+                          "fetched": time.time()}
+        if result.status == 304:
+            # a 304 may omit validators that did not change
+            for key in ("etag", "last_modified"):
+                new_validators[key] = new_validators[key] or (validators or {}).get(key)
+            return None, new_validators
 
-    def __init__(self, cache_path, base_url, force_remote=False):
-        self.cached_provider = CachedProvider(cache_path)
-        self.remote_provider = RemoteProvider(base_url)
+        return result.data, new_validators
+
+
+class CachedOrRemoteProvider(Provider):
+    """
+    Serves data from the local cache and falls back to the remote server.
+
+    :param force_remote: always refetch, ignoring the cache
+    :param revalidate: send conditional requests for cached entries; `304 Not Modified` answers are served from cache
+    :param cache_backend: storage of the local cache, see `data.cache_backend`
+    :param compression: compression of newly cached responses, see `CachedProvider`
+    :param max_retries: see `RemoteProvider`
+    :param max_in_flight: see `RemoteProvider`
+    """
+
+    def __init__(self, cache_path, base_url, force_remote=False, pool_size=DEFAULT_POOL_SIZE, revalidate=False,
+                 cache_backend: CacheBackend = None, compression="none", max_retries=DEFAULT_MAX_RETRIES,
+                 max_in_flight=None):
+        self.cached_provider = CachedProvider(cache_path, cache_backend, compression)
+        self.remote_provider = RemoteProvider(base_url, pool_size, max_retries=max_retries,
+                                              max_in_flight=max_in_flight)
         self.force_remote = force_remote
+        self.revalidate = revalidate
 
     def _get_raw_data(self, uri: str, **kwargs):
+        raw_data = None
+        validators = None
         if not self.force_remote:
             raw_data = self.cached_provider._get_raw_data(uri, **kwargs)
             if raw_data is not None:
-                return raw_data
+                if not self.revalidate:
+                    return raw_data
+                validators = self.cached_provider._get_validators(uri, **kwargs)
 
-        raw_data = self.remote_provider._get_raw_data(uri, **kwargs)
+        remote_data, validators = self.remote_provider._get_raw_response(uri, validators, **kwargs)
         kwargs["mode_postfix"] = "b"
-        self.cached_provider._save_raw_data(uri, raw_data, **kwargs)
-
-        return raw_data
-
+        if remote_data is None:
+            logger.debug("Not modified: %s", uri)
+            self.cached_provider._save_validators(uri, validators, **kwargs)
+            return raw_data
+
+        self.cached_provider._save_raw_data(uri, remote_data, **kwargs)
+        # without revalidation, or validators to send, the sidecar file would only double the cache entries
+        if self.revalidate and (validators["etag"] or validators["last_modified"]):
+            self.cached_provider._save_validators(uri, validators, **kwargs)
+
+        return decompress(remote_data)
+
+    def invalidate(self, uri: str, **kwargs):
+        """
+        Drops the cached copy of `uri`, e.g. a truncated response which could not be parsed, so it is requested
+        again next time.
+        """
+        logger.debug("Removing from cache: %s", uri)
+        self.cached_provider._delete_raw_data(uri, **kwargs)
+
+    def close(self):
+        self.cached_provider.close()
@@ -0,0 +1,311 @@
+import hashlib
+import logging
+import math
+import threading
+from collections import OrderedDict
+
+import dask.array
+import numpy
+import xarray
+
+from data.dods_parser import parse_dods_array
+
+logger = logging.getLogger("opendapViz")
+
+DEFAULT_TILE_SIZE = 256
+
+# numpy types of the decoded values, 16 bit integers are transferred as 32 bit values
+NCML_TYPES = {
+    "byte": numpy.dtype("u1"),
+    "short": numpy.dtype("i4"),
+    "int": numpy.dtype("i4"),
+    "float": numpy.dtype("f4"),
+    "double": numpy.dtype("f8"),
+}
+
+
+class RemoteArray:
+    """
+    Array-like view of a variable of a remote OPeNDAP dataset. Indexing it requests only the selected hyperslab,
+    using a constraint expression like `t[0:1:0][10:2:200][0:2:300]`, so it can be wrapped by
+    `dask.array.from_array`.
+
+    :param provider: `RemoteProvider` used for the requests
+    :param dataset_url: OPeNDAP url of the dataset, without extension
+    :param shape: remote shape of the variable
+    :param window: per dimension `(start, stride, count)` of the remote indexes visible through this view,
+        e.g. a bounding box at reduced resolution. Defaults to all indexes.
+    :param cache: `SliceCache` of the fetched hyperslabs, if any
+    """
+
+    def __init__(self, provider, dataset_url, variable, shape, dtype=numpy.float64, window=None, cache=None):
+        self.provider = provider
+        self.cache = cache
+        self.dataset_url = dataset_url
+        self.variable = variable
+        self.window = tuple(window or ((0, 1, size) for size in shape))
+        self.shape = tuple(count for _, _, count in self.window)
+        self.ndim = len(self.shape)
+        self.dtype = numpy.dtype(dtype)
+
+    def _remote_ranges(self, key):
+        """
+        :return: per dimension `(start, stride, count)` in remote indexes and the dimensions indexed by an integer
+        """
+        if not isinstance(key, tuple):
+            key = (key,)
+        key = key + (slice(None),) * (self.ndim - len(key))
+
+        ranges = []
+        squeeze = []
+        for dim, (index, (w_start, w_stride, w_count)) in enumerate(zip(key, self.window)):
+            if isinstance(index, slice):
+                start, stop, step = index.indices(w_count)
+                if step < 0:
+                    raise IndexError("Negative steps are not supported")
+            else:
+                start = int(index) + w_count if int(index) < 0 else int(index)
+                if not 0 <= start < w_count:
+                    raise IndexError("Index %d out of range for dimension %d" % (index, dim))
+                stop, step = start + 1, 1
+                squeeze.append(dim)
+            count = len(range(start, stop, step))
+            ranges.append((w_start + w_stride * start, w_stride * step, count))
+        return ranges, tuple(squeeze)
+
+    def constraint(self, ranges):
+        return self.variable + "".join("[%d:%d:%d]" % (start, stride, start + stride * (count - 1))
+                                       for start, stride, count in ranges)
+
+    def fetch(self, ranges):
+        """
+        Requests the hyperslab given by remote `(start, stride, count)` ranges, or takes it from the cache.
+        """
+        if self.cache is not None:
+            return self.cache.get_or_fetch(self._cache_key(ranges), lambda: self._request(ranges))
+        return self._request(ranges)
+
+    def cached(self, ranges):
+        """
+        The hyperslab given by `ranges` if it is in the cache, None otherwise. Never sends a request.
+        """
+        if self.cache is None:
+            return None
+        return self.cache.get(self._cache_key(ranges))
+
+    def _cache_key(self, ranges):
+        return self.dataset_url, self.variable, tuple(tuple(dim_range) for dim_range in ranges)
+
+    def _request(self, ranges):
+        url = self.dataset_url + ".dods?" + self.constraint(ranges)
+        logger.debug("Fetching: %s" % url)
+        return parse_dods_array(self.provider.request(url)).reshape([count for _, _, count in ranges])
+
+    def __getitem__(self, key):
+        ranges, squeeze = self._remote_ranges(key)
+        if any(count == 0 for _, _, count in ranges):
+            values = numpy.empty([count for _, _, count in ranges], dtype=self.dtype)
+        else:
+            values = self.fetch(ranges).astype(self.dtype, copy=False)
+        return values.squeeze(axis=squeeze) if squeeze else values
+
+
+def window_for_range(values, vmin, vmax, stride=1):
+    """
+    Smallest window `(start, stride, count)` of a coordinate covering all values within `vmin` and `vmax`.
+    """
+    indexes = numpy.flatnonzero((values >= vmin) & (values <= vmax))
+    if len(indexes) == 0:
+        # nothing inside, take the value closest to the range
+        indexes = [int(numpy.argmin(numpy.abs(values - (vmin + vmax) / 2.0)))]
+    start, end = int(indexes[0]), int(indexes[-1])
+    return start, stride, (end - start) // stride + 1
+
+
+def _load_coordinates(provider, dataset_url, meta, dims, window, cache=None):
+    """
+    Values of the coordinate variables of `dims` within `window`, index ranges for dimensions without one.
+    """
+    coords = OrderedDict()
+    for dim, (start, stride, count) in zip(dims, window):
+        if dim in meta["variables"] and meta["variables"][dim]["shape"] == [dim]:
+            coordinate = RemoteArray(provider, dataset_url, dim, [int(meta["dimensions"][dim])],
+                                     NCML_TYPES.get(meta["variables"][dim]["type"], numpy.float64),
+                                     [(start, stride, count)], cache)
+            coords[dim] = coordinate[:]
+        else:
+            coords[dim] = numpy.arange(start, start + stride * count, stride)
+    return coords
+
+
+def open_remote_dataarray(provider, dataset_url, name, meta, windows=None, chunks=None, cache=None):
+    """
+    Lazy `xarray.DataArray` of the variable `name` of a remote dataset, backed by a dask array of `RemoteArray`
+    hyperslabs. Only the values of coordinate variables are requested right away.
+
+    :param meta: meta information of the dataset as stored in the index, with `dimensions` and `variables`
+    :param windows: maps dimension names to `(start, stride, count)`, see `RemoteArray`
+    :param chunks: defaults to one chunk per layer of the last two dimensions
+    :param cache: `SliceCache` shared by the `RemoteArray`s
+    """
+    windows = windows or {}
+    variable = meta["variables"][name]
+    dims = variable["shape"]
+    window = [windows.get(dim) or (0, 1, int(meta["dimensions"][dim])) for dim in dims]
+
+    coords = _load_coordinates(provider, dataset_url, meta, dims, window, cache)
+    array = RemoteArray(provider, dataset_url, name, [int(meta["dimensions"][dim]) for dim in dims],
+                        NCML_TYPES.get(variable["type"], numpy.float64), window, cache)
+    if chunks is None:
+        chunks = (1,) * max(0, array.ndim - 2) + array.shape[-2:]
+    token = hashlib.sha1(repr((dataset_url, name, window)).encode("utf-8")).hexdigest()
+    data = dask.array.from_array(array, chunks=chunks, name="opendap-" + token, lock=False)
+    attrs = {key: attribute["value"] for key, attribute in variable.get("attributes", {}).items()}
+    return xarray.DataArray(data, coords=coords, dims=dims, name=name, attrs=attrs)
+
+
+class LayerPyramid:
+    """
+    Serves 2-D layers of a remote variable whose last two dimensions are latitude and longitude, at a resolution
+    matching the viewport: level `k` holds every `2 ** k`-th value in both directions, and the coarsest level
+    showing the viewport with at most `max_shape` values is used. Levels are fetched in tiles of
+    `tile_size` x `tile_size` values using strided constraint expressions. Tiles are kept by the cache of the
+    array, so zooming and panning only requests missing tiles.
+
+    :param array: `RemoteArray` of the full variable
+    :param coords: values of all dimensions of the variable
+    """
+
+    def __init__(self, array: RemoteArray, coords, max_shape=(640, 800), tile_size=DEFAULT_TILE_SIZE):
+        self.array = array
+        self.coords = coords
+        self.lat_values, self.lon_values = list(coords.values())[-2:]
+        self.max_shape = max_shape
+        self.tile_size = tile_size
+
+    def level_for(self, rows, cols):
+        level = 0
+        while math.ceil(rows / 2 ** level) > self.max_shape[0] or math.ceil(cols / 2 ** level) > self.max_shape[1]:
+            level += 1
+        return level
+
+    def _tile(self, layer, level, tile_row, tile_col, cached_only=False):
+        stride = 2 ** level
+        rows = min(self.tile_size, math.ceil(len(self.lat_values) / stride) - tile_row * self.tile_size)
+        cols = min(self.tile_size, math.ceil(len(self.lon_values) / stride) - tile_col * self.tile_size)
+        ranges = [(index, 1, 1) for index in layer] + [(tile_row * self.tile_size * stride, stride, rows),
+                                                      (tile_col * self.tile_size * stride, stride, cols)]
+        values = self.array.cached(ranges) if cached_only else self.array.fetch(ranges)
+        return values.reshape(rows, cols) if values is not None else None
+
+    @staticmethod
+    def _index_range(values, value_range):
+        if value_range is None or None in value_range:
+            return 0, len(values) - 1
+        start, _, count = window_for_range(values, min(value_range), max(value_range))
+        return start, start + count - 1
+
+    def region(self, layer, lon_range=None, lat_range=None, cached_only=False):
+        """
+        :param layer: indexes of the leading dimensions
+        :param lon_range: visible `(min, max)` longitudes, defaults to all
+        :param cached_only: only use cached tiles, e.g. on an event loop, and return None if one is missing
+        :return: longitude values, latitude values and the 2-D values of the viewport at the matching level
+        """
+        layer = tuple(int(index) for index in layer)
+        lat_start, lat_end = self._index_range(self.lat_values, lat_range)
+        lon_start, lon_end = self._index_range(self.lon_values, lon_range)
+        level = self.level_for(lat_end - lat_start + 1, lon_end - lon_start + 1)
+        stride = 2 ** level
+
+        # level indexes of the viewport and the tiles containing them
+        row_start, row_end = lat_start // stride, lat_end // stride
+        col_start, col_end = lon_start // stride, lon_end // stride
+        tile_rows = range(row_start // self.tile_size, row_end // self.tile_size + 1)
+        tile_cols = range(col_start // self.tile_size, col_end // self.tile_size + 1)
+        tiles = [[self._tile(layer, level, tile_row, tile_col, cached_only) for tile_col in tile_cols]
+                 for tile_row in tile_rows]
+        if any(tile is None for row in tiles for tile in row):
+            return None
+        values = numpy.vstack([numpy.hstack(row) for row in tiles])
+
+        row_offset = tile_rows[0] * self.tile_size
+        col_offset = tile_cols[0] * self.tile_size
+        values = values[row_start - row_offset:row_end - row_offset + 1,
+                        col_start - col_offset:col_end - col_offset + 1]
+        return (self.lon_values[col_start * stride:col_end * stride + 1:stride],
+                self.lat_values[row_start * stride:row_end * stride + 1:stride], values)
+
+
+class LayerPrefetcher:
+    """
+    Loads the layers next to the one shown in the background, e.g. into the cache of a `LayerPyramid`, so stepping
+    through model levels or time steps does not wait for the server. After layer `k` of a dimension is shown, `k - 1`
+    and `k + 1` are requested, and `ahead` layers in the direction the layers were stepped. Requests that did not
+    start yet are dropped when another layer is shown.
+
+    :param load_layer: called with the indexes of a layer and the extra arguments of `shown`
+    :param shape: number of layers of each leading dimension
+    :param executor: executor running the requests
+    """
+
+    def __init__(self, load_layer, shape, executor, ahead=3):
+        self.load_layer = load_layer
+        self.shape = tuple(shape)
+        self.executor = executor
+        self.ahead = ahead
+        self._previous = None
+        self._futures = {}
+        self._lock = threading.Lock()
+
+    def neighbours(self, layer):
+        moved = None
+        if self._previous is not None:
+            changed = [dim for dim, (a, b) in enumerate(zip(self._previous, layer)) if a != b]
+            if len(changed) == 1:
+                moved = changed[0]
+
+        layers = []
+        for dim, size in enumerate(self.shape):
+            steps = [-1, 1]
+            if dim == moved:
+                direction = 1 if layer[dim] > self._previous[dim] else -1
+                steps = [direction * step for step in range(1, self.ahead + 1)] + [-direction]
+            for step in steps:
+                if 0 <= layer[dim] + step < size:
+                    layers.append(layer[:dim] + (layer[dim] + step,) + layer[dim + 1:])
+        return layers
+
+    def _load(self, layer, args):
+        try:
+            self.load_layer(layer, *args)
+        except Exception as e:
+            logger.debug("Failed to prefetch layer %s: %s" % (layer, e))
+
+    def shown(self, layer, *args):
+        """
+        Requests the neighbours of the shown `layer`, `args` are passed on to `load_layer`.
+        """
+        layer = tuple(int(index) for index in layer)
+        with self._lock:
+            wanted = self.neighbours(layer)
+            self._previous = layer
+            for key, future in list(self._futures.items()):
+                if future.done() or (key not in wanted and future.cancel()):
+                    del self._futures[key]
+            for neighbour in wanted:
+                if neighbour not in self._futures:
+                    self._futures[neighbour] = self.executor.submit(self._load, neighbour, args)
+
+
+def open_layer_pyramid(provider, dataset_url, name, meta, cache=None, **kwargs):
+    """
+    `LayerPyramid` of the variable `name` of a remote dataset, see `open_remote_dataarray` for the parameters.
+    """
+    variable = meta["variables"][name]
+    dims = variable["shape"]
+    shape = [int(meta["dimensions"][dim]) for dim in dims]
+    coords = _load_coordinates(provider, dataset_url, meta, dims, [(0, 1, size) for size in shape], cache)
+    array = RemoteArray(provider, dataset_url, name, shape, NCML_TYPES.get(variable["type"], numpy.float64),
+                        cache=cache)
+    return LayerPyramid(array, coords, **kwargs)
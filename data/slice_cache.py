@@ -0,0 +1,204 @@
+import hashlib
+import logging
+import os
+import shutil
+import socket
+import tempfile
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+import numpy
+
+logger = logging.getLogger("opendapViz")
+
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+DEFAULT_MAX_SPILL_BYTES = 4 * DEFAULT_MAX_BYTES
+
+
+def _process_running(pid):
+    if os.name != "posix":
+        # no cheap check, the directories of other processes are kept
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _process_spill_dir(spill_dir):
+    """
+    The subdirectory of this process in `spill_dir`, so processes sharing it never map files written by another.
+    It is cleared, as are the subdirectories of processes of this host which are not running any more.
+    """
+    spill_dir = Path(spill_dir)
+    host = socket.gethostname()
+    own = spill_dir / ("%s-%d" % (host, os.getpid()))
+    if spill_dir.is_dir():
+        for path in spill_dir.iterdir():
+            path_host, _, pid = path.name.rpartition("-")
+            if path == own or (path_host == host and pid.isdigit() and not _process_running(int(pid))):
+                shutil.rmtree(str(path), ignore_errors=True)
+    return own
+
+
+class SliceCache:
+    """
+    Memory bounded LRU cache of fetched hyperslabs, keyed by dataset url, variable and remote index ranges.
+
+    Entries evicted from memory are kept as `.npy` files in a subdirectory of `spill_dir` per process, if given, up
+    to `max_spill_bytes` (None for no limit), and memory mapped when they are requested again. Concurrent requests of
+    the same key are fetched once.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES, spill_dir=None, max_spill_bytes=DEFAULT_MAX_SPILL_BYTES):
+        self.max_bytes = max_bytes
+        self.spill_dir = _process_spill_dir(spill_dir) if spill_dir is not None else None
+        self.max_spill_bytes = max_spill_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._size = 0
+        # key -> (path, size) of spilled entries, least recently used first
+        self._spilled = OrderedDict()
+        self._spilled_size = 0
+        # key -> values of entries being written to `spill_dir`, still served from memory
+        self._spilling = {}
+        # key -> event set once a running fetch finished
+        self._fetching = {}
+        self.hits = 0
+        self.spill_hits = 0
+        self.misses = 0
+
+    def _spill_path(self, key):
+        return self.spill_dir / (hashlib.sha1(repr(key).encode("utf-8")).hexdigest() + ".npy")
+
+    def _lookup(self, key):
+        # called with the lock held
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return self._entries[key]
+        if key in self._spilling:
+            self.hits += 1
+            return self._spilling[key]
+        if key in self._spilled:
+            self._spilled.move_to_end(key)
+            try:
+                values = numpy.load(str(self._spilled[key][0]), mmap_mode="r")
+            except (OSError, ValueError) as e:
+                logger.warning("Dropping broken spilled slice: %s" % e)
+                self._spilled_size -= self._spilled.pop(key)[1]
+                return None
+            self.spill_hits += 1
+            return values
+        return None
+
+    def get(self, key):
+        with self._lock:
+            return self._lookup(key)
+
+    def put(self, key, values: numpy.ndarray):
+        values.setflags(write=False)
+        to_spill = []
+        with self._lock:
+            if key in self._entries:
+                self._size -= self._entries.pop(key).nbytes
+            self._entries[key] = values
+            self._size += values.nbytes
+            while self._size > self.max_bytes and len(self._entries) > 1:
+                evicted_key, evicted = self._entries.popitem(last=False)
+                self._size -= evicted.nbytes
+                if self.spill_dir is not None and evicted_key not in self._spilled and \
+                        evicted_key not in self._spilling:
+                    self._spilling[evicted_key] = evicted
+                    to_spill.append((evicted_key, evicted))
+
+        # written without holding the lock, so lookups of other sessions do not wait for the disk
+        for evicted_key, evicted in to_spill:
+            self._spill(evicted_key, evicted)
+
+    def _spill(self, key, values):
+        path = self._spill_path(key)
+        try:
+            self.spill_dir.mkdir(parents=True, exist_ok=True)
+            # written under a temporary name, so an incomplete file is never mapped
+            fd, tmp_path = tempfile.mkstemp(dir=str(self.spill_dir), prefix=".tmp-")
+            try:
+                with os.fdopen(fd, "wb") as file:
+                    numpy.save(file, values)
+                os.replace(tmp_path, str(path))
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+        except OSError as e:
+            logger.warning("Failed to spill slice to %s: %s" % (path, e))
+            path = None
+
+        to_remove = []
+        with self._lock:
+            self._spilling.pop(key, None)
+            if path is None:
+                return
+            self._spilled[key] = (path, values.nbytes)
+            self._spilled_size += values.nbytes
+            while self.max_spill_bytes is not None and self._spilled_size > self.max_spill_bytes:
+                _, (spilled_path, size) = self._spilled.popitem(last=False)
+                self._spilled_size -= size
+                to_remove.append(spilled_path)
+
+        for spilled_path in to_remove:
+            try:
+                os.unlink(str(spilled_path))
+            except OSError:
+                pass
+
+    def get_or_fetch(self, key, fetch):
+        """
+        Returns the cached values of `key` or calls `fetch()` and caches its result. If another thread already
+        fetches `key`, its result is awaited instead.
+        """
+        while True:
+            with self._lock:
+                values = self._lookup(key)
+                if values is not None:
+                    return values
+                running = self._fetching.get(key)
+                if running is None:
+                    self.misses += 1
+                    self._fetching[key] = threading.Event()
+            if running is None:
+                break
+            running.wait()
+
+        try:
+            values = fetch()
+            self.put(key, values)
+            return values
+        finally:
+            with self._lock:
+                self._fetching.pop(key).set()
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "spill_hits": self.spill_hits, "misses": self.misses,
+                    "entries": len(self._entries), "bytes": self._size,
+                    "spilled_entries": len(self._spilled), "spilled_bytes": self._spilled_size}
+
+
+_slice_cache = None
+_slice_cache_lock = threading.Lock()
+
+
+def get_slice_cache(max_bytes=DEFAULT_MAX_BYTES, spill_dir=None, max_spill_bytes=DEFAULT_MAX_SPILL_BYTES):
+    """
+    The `SliceCache` shared by the whole process, e.g. by all sessions of the bokeh server. The parameters are only
+    used when it is created by the first call.
+    """
+    global _slice_cache
+    with _slice_cache_lock:
+        if _slice_cache is None:
+            _slice_cache = SliceCache(max_bytes, spill_dir, max_spill_bytes)
+        return _slice_cache
@@ -1,12 +1,18 @@
+import json
 import logging
+import os
 import sys
 from logging import DEBUG, StreamHandler
 
 import numpy
 
-from data.loader import Loader, Exclude, Include
+from data.cache_backend import CACHE_LAYOUTS, create_cache_backend
+from data.compression import COMPRESSIONS
+from data.index_io import NDJSON_INDEX_EXT, is_ndjson_index
+from data.loader import Loader, DateRange, Exclude, Include, DEFAULT_CONCURRENCY
+from data.provider import DEFAULT_MAX_RETRIES
 from data.model import DatasetsIndex
-from util import excel2time
+from util import excel2time_array, write_file
 
 logger = logging.getLogger("opendapViz")
 formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
@@ -18,6 +24,13 @@ logger.setLevel(DEBUG)
 import click
 
 
+def _parse_date(ctx, param, value):
+    try:
+        return DateRange.to_date(value)
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+
+
 @click.command()
 @click.argument('url')
 @click.argument('output-file')
@@ -26,19 +39,68 @@ import click
 @click.option('--base-folder', default="", help="Start at this sub folder not the top hierachy")
 @click.option('--dataset-include', default=None, help="Comma separated list of include filters for dataset names")
 @click.option('--dataset-exclude', default=None)
+@click.option('--dataset-include-glob', default=None,
+              help="Comma separated list of glob patterns matching the whole dataset name, e.g. '*_DOM01_*.nc'")
+@click.option('--dataset-exclude-glob', default=None)
+@click.option('--date-from', default=None, callback=_parse_date,
+              help="Only datasets whose last date in the name is on or after, YYYY-MM-DD")
+@click.option('--date-to', default=None, callback=_parse_date,
+              help="Only datasets whose last date in the name is on or before, YYYY-MM-DD")
 @click.option('--catalog-include', default=None)
 @click.option('--catalog-exclude', default=None)
 @click.option('--local-cache-dir', default=".cache", help="Local cache folder (will be created)")
 @click.option('--modify-timestamp', default="none", type=click.Choice(['none', 'excel']))
+@click.option('--concurrency', default=DEFAULT_CONCURRENCY, type=int,
+              help="Maximum number of concurrent requests for the whole crawl")
+@click.option('--pool-size', default=None, type=int,
+              help="Keep-alive connections per host (defaults to the concurrency)")
+@click.option('--revalidate', is_flag=True, default=False,
+              help="Revalidate cached files with conditional requests (ETag / Last-Modified)")
+@click.option('--update', default=None, type=click.Path(exists=True, dir_okay=False),
+              help="Existing index to update. Only new or changed datasets are retrieved.")
+@click.option('--keep-attributes', is_flag=True, default=False,
+              help="Keep the global attributes of the datasets. Each distinct set is stored once.")
+@click.option('--multi-schema', is_flag=True, default=False,
+              help="Group datasets with differing variables or dimensions into schemas instead of ignoring them")
+@click.option('--parsed-cache/--no-parsed-cache', default=True,
+              help="Cache parsed catalogs and NcML files next to the raw files")
+@click.option('--cache-layout', default="mirror", type=click.Choice(CACHE_LAYOUTS),
+              help="mirror: one file per remote path, sharded: hashed file names with an index and LRU eviction")
+@click.option('--cache-max-size', default=None, type=int,
+              help="Maximum size of the sharded cache in MB, least recently used files are evicted")
+@click.option('--cache-compression', default="none", type=click.Choice(COMPRESSIONS),
+              help="Compression of newly cached files (zstd requires the zstandard package)")
+@click.option('--max-retries', default=DEFAULT_MAX_RETRIES, type=int,
+              help="Retries of failed requests, with exponential backoff")
+@click.option('--max-in-flight', default=None, type=int,
+              help="Maximum number of concurrent requests per host (defaults to the pool size)")
+@click.option('--retry-report', default=None,
+              help="Write the requests that failed after all retries to this JSON file")
+@click.option('--checkpoint-file', default=None,
+              help="Crawl checkpoint journal (defaults to crawl_checkpoint.pickle in the cache folder)")
+@click.option('--resume', is_flag=True, default=False,
+              help="Continue the crawl saved in the checkpoint file, retrying failed requests")
+@click.option('--stream', is_flag=True, default=False,
+              help="Retrieve and write datasets while crawling instead of keeping all in memory (.ndjson output)")
 def load_catalog_data(url, base_folder, output_file, dataset_include, catalog_folder, catalog_include, catalog_exclude,
-                      dataset_exclude,
-                      local_cache_dir, modify_timestamp):
+                      dataset_exclude, dataset_include_glob, dataset_exclude_glob, date_from, date_to,
+                      local_cache_dir, modify_timestamp, concurrency, pool_size, revalidate, update, keep_attributes,
+                      multi_schema, parsed_cache, cache_layout, cache_max_size, cache_compression, max_retries,
+                      max_in_flight, retry_report, checkpoint_file, resume, stream):
     """
     Recursively load data from the given server using ncml and opendap.
     """
-    print(url, dataset_include, catalog_folder)
-
-    loader = Loader(local_cache_dir, url, catalog_folder)
+    if stream and not is_ndjson_index(output_file):
+        raise click.BadParameter("--stream requires an output file ending with %s" % NDJSON_INDEX_EXT,
+                                 param_hint="output-file")
+    if stream and resume:
+        raise click.UsageError("--resume can not be combined with --stream")
+
+    max_size = cache_max_size * 1024 * 1024 if cache_max_size is not None else None
+    cache_backend = create_cache_backend(cache_layout, local_cache_dir, max_size)
+    loader = Loader(local_cache_dir, url, catalog_folder, concurrency, pool_size, revalidate, parsed_cache,
+                    cache_backend, cache_compression, max_retries, max_in_flight,
+                    None if stream else checkpoint_file or os.path.join(local_cache_dir, "crawl_checkpoint.pickle"))
 
     if dataset_include is not None:
         for key in dataset_include.split(","):
@@ -48,6 +110,17 @@ def load_catalog_data(url, base_folder, output_file, dataset_include, catalog_fo
         for key in dataset_exclude.split(","):
             loader.add_filter(Exclude(key), "dataset")
 
+    if dataset_include_glob is not None:
+        for key in dataset_include_glob.split(","):
+            loader.add_filter(Include(key, glob=True), "dataset")
+
+    if dataset_exclude_glob is not None:
+        for key in dataset_exclude_glob.split(","):
+            loader.add_filter(Exclude(key, glob=True), "dataset")
+
+    if date_from is not None or date_to is not None:
+        loader.add_filter(DateRange(date_from, date_to), "dataset")
+
     if catalog_include is not None:
         for key in catalog_include.split(","):
             loader.add_filter(Include(key), "catalog")
@@ -59,23 +132,38 @@ def load_catalog_data(url, base_folder, output_file, dataset_include, catalog_fo
     # data_url = "http://eos.scc.kit.edu/"
     # data_url_noaa = "https://dods.ndbc.noaa.gov/"
 
-    cat = loader.load_catalog_recursively(base_folder, "catalog.xml")
-
-    format_kit_icon_timestamp = lambda tv: str(
-        (excel2time(float(tv)) + numpy.timedelta64(500, 'ms')).astype("datetime64[s]"))
+    format_kit_icon_timestamp = lambda tv: numpy.datetime_as_string(excel2time_array(tv), unit="s")
     format_none = lambda x: x
 
     format_func = format_none
     if modify_timestamp == "excel":
         format_func = format_kit_icon_timestamp
 
-    index = DatasetsIndex(url, loader, {"time": format_func})
-
-    count = len(loader.loaded_dataset_metas)
-    for i, dsi in enumerate(loader.loaded_dataset_metas):
-        logger.debug("Entry %s: %d of %d" % (dsi.id, i, count))
-        index.add_dataset(dsi)
-    index.save(output_file)
+    # buffered cache data is written even if the crawl fails or is interrupted
+    with loader:
+        index = DatasetsIndex(url, loader, {"time": format_func}, multi_schema)
+        if update is not None:
+            index.load_previous(update)
+
+        if stream:
+            # datasets go from the crawl straight to the index file
+            index.open_stream(output_file, keep_attributes)
+            loader.dataset_meta_consumer = index.submit_dataset
+            try:
+                loader.load_catalog_recursively(base_folder, "catalog.xml")
+            finally:
+                index.close_stream()
+        else:
+            loader.load_catalog_recursively(base_folder, "catalog.xml", resume)
+            # sorted to keep the index independent of the order in which the crawl finished
+            index.add_datasets(sorted(loader.loaded_dataset_metas, key=lambda dsi: dsi.id), keep_attributes)
+            index.save(output_file)
+
+    report = loader.retry_report()
+    if report["failures"]:
+        logger.warning("%d requests failed, rerun to retry them" % len(report["failures"]))
+    if retry_report is not None:
+        write_file(json.dumps(report, indent=2), retry_report, "w")
 
 
 if __name__ == "__main__":
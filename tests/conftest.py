@@ -0,0 +1,75 @@
+import threading
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+import pytest
+
+
+class StandInServer(ThreadingMixIn, HTTPServer):
+    """
+    Local HTTP/1.1 server answering GET requests from `routes`, which maps paths to response bodies or to
+    functions returning `(status, body)` or `(status, body, headers)`. Counts accepted connections and requests per
+    path, and keeps the headers of the last request per path.
+    """
+    daemon_threads = True
+
+    def __init__(self, routes):
+        super().__init__(("127.0.0.1", 0), _StandInHandler)
+        self.routes = routes
+        self.connections = 0
+        self.requests = Counter()
+        self.request_headers = {}
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:%d/" % self.server_address[1]
+
+
+class _StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def do_GET(self):
+        with self.server.lock:
+            self.server.requests[self.path] += 1
+            self.server.request_headers[self.path] = self.headers
+        route = self.server.routes.get(self.path)
+        headers = {}
+        if route is None:
+            status, body = 404, b"not found"
+        elif callable(route):
+            status, body, *headers = route()
+            headers = headers[0] if headers else {}
+        else:
+            status, body = 200, route
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def stand_in_server():
+    servers = []
+
+    def start(routes):
+        server = StandInServer(routes)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,114 @@
+import gzip
+import os
+import sqlite3
+
+from data.cache_backend import ShardedCacheBackend, SQLiteCacheBackend
+
+
+def _objects(cache_dir):
+    return sorted(path.basename for path in cache_dir.join("objects").visit() if path.isfile())
+
+
+def test_sharded_evicts_the_least_recently_used_entries(tmpdir):
+    backend = ShardedCacheBackend(str(tmpdir), max_size=30)
+    for key in ("a", "b", "c"):
+        backend.write(key, key.encode() * 10)
+    assert backend.read("a") == b"a" * 10
+
+    backend.write("d", b"d" * 10)
+    assert backend.read("b") is None
+    assert [backend.read(key) for key in ("a", "c", "d")] == [b"a" * 10, b"c" * 10, b"d" * 10]
+    assert _objects(tmpdir) == sorted(backend._digest(key) for key in ("a", "c", "d"))
+
+
+def test_sharded_stays_below_its_maximum_size(tmpdir):
+    backend = ShardedCacheBackend(str(tmpdir), max_size=1000)
+    for i in range(100):
+        backend.write("k%d" % i, b"x" * (i % 7 + 20))
+        assert backend._total_size <= 1000
+    assert sum(os.path.getsize(str(path)) for path in tmpdir.join("objects").visit() if path.isfile()) == \
+        backend._total_size
+    # the most recent entry is kept even if it alone exceeds the limit
+    backend.write("large", b"x" * 2000)
+    assert backend.read("large") == b"x" * 2000
+    assert _objects(tmpdir) == [backend._digest("large")]
+
+
+def test_sharded_keeps_the_usage_order_when_reopened(tmpdir):
+    backend = ShardedCacheBackend(str(tmpdir), max_size=30)
+    for key in ("a", "b", "c"):
+        backend.write(key, key.encode() * 10)
+    backend.read("a")
+    backend.close()
+
+    reopened = ShardedCacheBackend(str(tmpdir), max_size=30)
+    assert reopened._total_size == 30
+    reopened.write("d", b"d" * 10)
+    assert reopened.read("b") is None
+    assert reopened.read("a") == b"a" * 10
+
+
+def test_sharded_index_is_restored_from_its_log(tmpdir):
+    backend = ShardedCacheBackend(str(tmpdir), flush_interval=2)
+    for i in range(3):
+        backend.write("k%d" % i, b"x" * i)
+    backend.close()
+
+    # changes after the index was written are only in the log
+    backend = ShardedCacheBackend(str(tmpdir), flush_interval=2)
+    backend.write("k3", b"xxx")
+    backend.write("k4", b"xxxx")
+    backend.delete("k1")
+    backend.flush()
+    # a killed process leaves an incomplete line behind
+    with open(str(tmpdir / ShardedCacheBackend.LOG_FILE), "a") as file:
+        file.write('["abc", 1')
+
+    reopened = ShardedCacheBackend(str(tmpdir))
+    assert list(reopened._entries) == [reopened._digest("k%d" % i) for i in (0, 2, 3, 4)]
+    assert reopened._total_size == 9
+
+    reopened.close()
+    assert not os.path.exists(str(tmpdir / ShardedCacheBackend.LOG_FILE))
+    assert ShardedCacheBackend(str(tmpdir))._entries == reopened._entries
+
+
+def _committed(cache_dir):
+    with sqlite3.connect(str(cache_dir.join(SQLiteCacheBackend.DATABASE_FILE))) as connection:
+        return sorted(key for key, in connection.execute("SELECT key FROM entries"))
+
+
+def test_sqlite_commits_in_batches(tmpdir):
+    backend = SQLiteCacheBackend(str(tmpdir), batch_size=3)
+    backend.write("a", b"a" * 100)
+    backend.write("b", b"b")
+    # pending entries are served before they are committed
+    assert _committed(tmpdir) == []
+    assert backend.read("a") == b"a" * 100
+
+    backend.write("c", b"c")
+    assert _committed(tmpdir) == ["a", "b", "c"]
+    backend.write("d", b"d")
+    backend.close()
+    assert _committed(tmpdir) == ["a", "b", "c", "d"]
+    backend.close()
+
+
+def test_sqlite_entries_persist_when_reopened(tmpdir):
+    compressed = gzip.compress(b"already compressed")
+    backend = SQLiteCacheBackend(str(tmpdir), batch_size=2)
+    backend.write("plain", b"plain " * 100)
+    backend.write("gzip", compressed)
+    backend.write("deleted", b"gone")
+    backend.delete("deleted")
+    backend.close()
+
+    reopened = SQLiteCacheBackend(str(tmpdir))
+    assert reopened.read("plain") == b"plain " * 100
+    # compressed content is stored and returned as it is
+    assert reopened.read("gzip") == compressed
+    assert reopened.read("deleted") is None
+    reopened.delete("plain")
+    assert reopened.read("plain") is None
+    reopened.close()
+    assert _committed(tmpdir) == ["gzip"]
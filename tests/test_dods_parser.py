@@ -0,0 +1,56 @@
+import struct
+
+import numpy
+import pytest
+
+from data.dods_parser import DodsParseError, parse_dods_array
+
+
+def _dods(dds, payload):
+    return ("Dataset {\n%s} f.nc;" % dds).encode() + b"\nData:\n" + payload
+
+
+def _array(fmt, values):
+    return struct.pack(">II", len(values), len(values)) + struct.pack(">%d%s" % (len(values), fmt), *values)
+
+
+def test_float64_array():
+    values = parse_dods_array(_dods("    Float64 time[time = 3];\n", _array("d", [0.0, 0.5, 42734.25])))
+    assert values.dtype == numpy.float64 and values.dtype.isnative
+    assert values.tolist() == [0.0, 0.5, 42734.25]
+
+
+def test_int16_array_is_sent_as_32_bit():
+    values = parse_dods_array(_dods("    Int16 level[level = 3];\n", _array("i", [-2, 0, 32767])))
+    assert values.dtype.isnative
+    assert values.tolist() == [-2, 0, 32767]
+
+
+def test_byte_array_is_padded():
+    payload = struct.pack(">II", 3, 3) + b"\x01\x02\xff\x00"
+    values = parse_dods_array(_dods("    Byte flags[flags = 3];\n", payload))
+    assert values.dtype == numpy.uint8
+    assert values.tolist() == [1, 2, 255]
+
+
+def test_grid_array_without_its_maps():
+    dds = ("    Grid {\n      ARRAY:\n        Float32 t[time = 1][lat = 2][lon = 3];\n"
+           "      MAPS:\n        Float64 time[time = 1];\n        Float64 lat[lat = 2];\n"
+           "        Float64 lon[lon = 3];\n    } t;\n")
+    payload = (_array("f", [1.0, 2.0, 3.0, 4.0, 5.0, 6.0]) + _array("d", [0.0]) + _array("d", [10.0, 20.0]) +
+               _array("d", [1.0, 2.0, 3.0]))
+    values = parse_dods_array(_dods(dds, payload))
+    assert values.shape == (1, 2, 3)
+    assert values.dtype.isnative
+    assert values[0].tolist() == [[1.0, 2.0, 3.0], [4.0, 5.0, 6.0]]
+
+
+@pytest.mark.parametrize("data", [
+    b"Error {\n    code = 404;\n};",
+    _dods("    Float64 time[time = 3];\n", _array("d", [0.0, 0.5, 1.0])[:-4]),
+    _dods("    Structure {\n        Float64 time[time = 1];\n    } s;\n", _array("d", [0.0])),
+    _dods("    String names[names = 1];\n", b""),
+])
+def test_unsupported_or_broken_responses(data):
+    with pytest.raises(DodsParseError):
+        parse_dods_array(data)
@@ -0,0 +1,28 @@
+import datetime
+
+import pytest
+
+from data.loader import CombinedFilter, DateRange, Exclude, Include
+
+NAMES = ["run_20160301/grid_DOM01_ML_0001.nc", "run_20160302/grid_DOM02_ML_0001.nc", "catalog.xml"]
+
+
+@pytest.mark.parametrize("filters", [
+    [Include(r"\.nc$"), Include("DOM01"), Exclude("DOM02")],
+    [Include(r"(?P<domain>DOM0\d)"), Include(r"(?P<domain>_ML_)")],
+    [Exclude(r"(?P<domain>DOM02)"), Exclude(r"(?P<domain>\.xml)")],
+    [Include(r"(DOM0\d)_\1|DOM01"), Include(r"(?i)grid")],
+])
+def test_combined_filter_matches_filters_one_by_one(filters):
+    combined = CombinedFilter(filters)
+    for name in NAMES:
+        assert combined.test(name) == all(f.test(name) for f in filters)
+
+
+def test_date_range_accepts_dates_only():
+    assert DateRange.to_date("2016-03-22") == DateRange.to_date("20160322") == datetime.date(2016, 3, 22)
+    for value in ("2016-13-01", "yesterday"):
+        with pytest.raises(ValueError):
+            DateRange(value)
+    date_range = DateRange("2016-03-02", None)
+    assert [date_range.test(name) for name in NAMES] == [False, True, True]
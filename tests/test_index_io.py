@@ -0,0 +1,39 @@
+import numpy
+
+from data.index_io import load_index, save_index
+
+INDEX = {
+    "base_url": "http://server/", "opendap_url": "http://server/thredds/dodsC/",
+    "meta": {"dimensions": {"time": "2"}}, "default_schema": "s1", "schemas": {"s1": {"dimensions": {"time": "2"}}},
+    "attribute_sets": {"a1": {"title": {"value": "Run"}}},
+    "datasets": [
+        {"id": "base/f0.nc", "schema": "s1", "signature": "x0", "attributes_id": "a1",
+         "data": {"time": ["2016-03-22T00:00:00", "2016-03-22T01:00:00"], "lev": [1.5, 2.5, 3.5]}},
+        {"id": "base/f1.nc", "schema": "s1", "signature": "x1",
+         "data": {"time": ["2016-03-22T02:00:00"], "lev": []}},
+    ],
+}
+
+
+def _as_lists(jdata):
+    for ds in jdata["datasets"]:
+        ds["data"] = {name: numpy.datetime_as_string(values).tolist()
+                      if numpy.issubdtype(values.dtype, numpy.datetime64) else values.tolist()
+                      for name, values in ds["data"].items()}
+    return jdata
+
+
+def test_index_formats_round_trip(tmpdir):
+    save_index(INDEX, str(tmpdir / "index.json"))
+    from_json = load_index(str(tmpdir / "index.json"))
+    assert from_json == INDEX
+
+    save_index(from_json, str(tmpdir / "index.npz"))
+    from_npz = load_index(str(tmpdir / "index.npz"))
+    # the coordinate columns are mapped, not read
+    assert isinstance(from_npz["datasets"][0]["data"]["lev"], numpy.memmap)
+    assert isinstance(from_npz["datasets"][0]["data"]["time"], numpy.memmap)
+
+    save_index(from_npz, str(tmpdir / "index.ndjson"))
+    assert _as_lists(from_npz) == INDEX
+    assert load_index(str(tmpdir / "index.ndjson")) == INDEX
@@ -0,0 +1,153 @@
+import asyncio
+import time
+
+import pytest
+
+from data.cache_backend import CACHE_LAYOUTS, create_cache_backend
+from data.loader import Loader
+from data.provider import ProviderError
+
+CATALOG = ('<?xml version="1.0"?>\n'
+           '<catalog xmlns="http://www.unidata.ucar.edu/namespaces/thredds/InvCatalog/v1.0" '
+           'xmlns:xlink="http://www.w3.org/1999/xlink" version="1.0.1">\n'
+           '<service name="all" serviceType="Compound" base="">'
+           '<service name="odap" serviceType="OPENDAP" base="thredds/dodsC/"/>'
+           '<service name="ncml" serviceType="NCML" base="thredds/ncml/"/></service>\n'
+           '<dataset name="base" ID="base">\n%s</dataset></catalog>')
+DATASET = '<dataset name="%s" ID="base/%s" urlPath="base/%s"/>\n'
+NCML = ('<?xml version="1.0"?>\n'
+        '<netcdf xmlns="http://www.unidata.ucar.edu/namespaces/netcdf/ncml-2.2" location="%s">\n'
+        '<dimension name="time" length="2"/>\n'
+        '<variable name="time" shape="time" type="double"/>\n'
+        '</netcdf>')
+NAMES = ["f%d.nc" % i for i in range(4)]
+
+
+def _routes(truncated):
+    routes = {"/thredds/catalog/base/catalog.xml": (CATALOG % "".join(DATASET % (n, n, n) for n in NAMES)).encode()}
+    for name in NAMES:
+        routes["/thredds/ncml/base/" + name] = (NCML % name).encode()
+
+    # the first answer of the truncated dataset is cut off
+    body = routes["/thredds/ncml/base/" + truncated]
+    answers = [body[:len(body) // 2], body]
+    routes["/thredds/ncml/base/" + truncated] = lambda: (200, answers.pop(0) if len(answers) > 1 else answers[0])
+    return routes
+
+
+def _crawl(server, cache_dir, layout="mirror", resume=False):
+    with Loader(str(cache_dir), server.url, "thredds/catalog/", concurrency=2,
+                cache_backend=create_cache_backend(layout, str(cache_dir)),
+                checkpoint_file=str(cache_dir / "checkpoint.pickle")) as loader:
+        loader.load_catalog_recursively("base/", "catalog.xml", resume)
+    return loader
+
+
+@pytest.mark.parametrize("layout", CACHE_LAYOUTS)
+def test_truncated_response_is_refetched_on_rerun(stand_in_server, tmpdir, layout):
+    server = stand_in_server(_routes("f2.nc"))
+    cache_dir = tmpdir.join("cache")
+
+    loader = _crawl(server, cache_dir, layout)
+    assert len(loader.loaded_dataset_metas) == 3
+    assert [failure["uri"] for failure in loader.failures] == ["base/f2.nc"]
+
+    loader = _crawl(server, cache_dir, layout)
+    assert sorted(dsi.id for dsi in loader.loaded_dataset_metas) == ["base/" + name for name in NAMES]
+    assert loader.failures == []
+    assert server.requests["/thredds/ncml/base/f2.nc"] == 2
+    # everything else is served from the cache
+    assert server.requests["/thredds/ncml/base/f0.nc"] == 1
+
+
+def test_resume_retries_failed_items_only(stand_in_server, tmpdir):
+    server = stand_in_server(_routes("f2.nc"))
+    cache_dir = tmpdir.join("cache")
+    loader = _crawl(server, cache_dir)
+    assert len(loader.failures) == 1
+
+    # a run killed while writing leaves an incomplete record behind
+    with open(str(cache_dir / "checkpoint.pickle"), "ab") as file:
+        file.write(b"\x80\x04\x95")
+
+    loader = _crawl(server, cache_dir, resume=True)
+    assert sorted(dsi.id for dsi in loader.loaded_dataset_metas) == ["base/" + name for name in NAMES]
+    assert loader.root_catalog is not None
+    assert server.requests["/thredds/ncml/base/f2.nc"] == 2
+    assert server.requests["/thredds/catalog/base/catalog.xml"] == 1
+    assert server.requests["/thredds/ncml/base/f0.nc"] == 1
+
+    # nothing is pending any more
+    requests = sum(server.requests.values())
+    loader = _crawl(server, cache_dir, resume=True)
+    assert len(loader.loaded_dataset_metas) == len(NAMES)
+    assert sum(server.requests.values()) == requests
+
+
+def test_cancelled_crawl_finishes(stand_in_server, tmpdir):
+    def slow_ncml():
+        time.sleep(0.2)
+        return 200, (NCML % "f.nc").encode()
+
+    routes = _routes("f2.nc")
+    for name in NAMES:
+        routes["/thredds/ncml/base/" + name] = slow_ncml
+    server = stand_in_server(routes)
+    cache_dir = tmpdir.join("cache")
+
+    with Loader(str(cache_dir), server.url, "thredds/catalog/", concurrency=2,
+                checkpoint_file=str(cache_dir / "checkpoint.pickle")) as loader:
+        loader.catalog_base_uri = "base/"
+        loop = asyncio.new_event_loop()
+        try:
+            crawl = loop.create_task(loader._crawl("catalog.xml"))
+            loop.call_later(0.1, crawl.cancel)
+            # an interrupted crawl must not wait for further queue items
+            loop.run_until_complete(asyncio.wait_for(asyncio.gather(crawl, return_exceptions=True), 5))
+        finally:
+            loop.close()
+
+    assert crawl.cancelled()
+    assert len(loader.loaded_dataset_metas) < len(NAMES)
+    # the journal was flushed, so the crawl can be resumed
+    loader = _crawl(server, cache_dir, resume=True)
+    assert sorted(dsi.id for dsi in loader.loaded_dataset_metas) == ["base/" + name for name in NAMES]
+    assert server.requests["/thredds/catalog/base/catalog.xml"] == 1
+
+
+def test_ascii_is_only_requested_if_the_binary_response_can_not_be_decoded(stand_in_server, tmpdir):
+    structure = b"Dataset {\n    Structure {\n        Float64 time[time = 3];\n    } s;\n} f.nc;\nData:\n"
+    # the brackets of the constraints arrive percent-encoded
+    server = stand_in_server({
+        "/thredds/dodsC/base/f0.nc.dods?time%5B0:1:2%5D": structure,
+        "/thredds/dodsC/base/f0.nc.ascii?time%5B0:1:2%5D": b"Dataset {\n} f.nc;\n-----\ntime[3]\n0.0, 1.5, 3.0\n",
+        "/thredds/dodsC/base/f1.nc.dods?time%5B0:1:2%5D": lambda: (404, b"not here"),
+    })
+    cache_dir = tmpdir.join("cache")
+    with Loader(str(cache_dir), server.url, "thredds/catalog/", max_retries=0) as loader:
+        loader.opendap_base_url = "thredds/dodsC/"
+        assert loader.load_opendap_array("base/f0.nc", "time", 3).tolist() == [0.0, 1.5, 3.0]
+        with pytest.raises(ProviderError):
+            loader.load_opendap_array("base/f1.nc", "time", 3)
+
+    assert server.requests["/thredds/dodsC/base/f1.nc.ascii?time%5B0:1:2%5D"] == 0
+
+
+def test_truncated_ascii_response_is_refetched(stand_in_server, tmpdir):
+    structure = b"Dataset {\n    Structure {\n        Float64 time[time = 3];\n    } s;\n} f.nc;\nData:\n"
+    body = b"Dataset {\n} f.nc;\n-----\ntime[3]\n0.0, 1.5, 3.0\n"
+    answers = [body[:-6], body]
+    server = stand_in_server({
+        "/thredds/dodsC/base/f0.nc.dods?time%5B0:1:2%5D": structure,
+        "/thredds/dodsC/base/f0.nc.ascii?time%5B0:1:2%5D": lambda: (200, answers.pop(0)),
+    })
+
+    def load():
+        with Loader(str(tmpdir.join("cache")), server.url, "thredds/catalog/", max_retries=0) as loader:
+            loader.opendap_base_url = "thredds/dodsC/"
+            return loader.load_opendap_array("base/f0.nc", "time", 3)
+
+    with pytest.raises(ValueError):
+        load()
+    assert load().tolist() == [0.0, 1.5, 3.0]
+    assert server.requests["/thredds/dodsC/base/f0.nc.ascii?time%5B0:1:2%5D"] == 2
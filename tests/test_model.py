@@ -0,0 +1,103 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy
+import pytest
+from lxml import etree
+
+from data import model
+from data.index_io import load_index
+from data.model import DatasetsIndex, catalog_from_xml_data
+from data.ncml_parser import parse_ncml_file
+
+NCML = ('<?xml version="1.0"?>\n'
+        '<netcdf xmlns="http://www.unidata.ucar.edu/namespaces/netcdf/ncml-2.2">\n'
+        '<dimension name="time" length="3"/>\n'
+        '<variable name="time" shape="time" type="double"/>\n'
+        '</netcdf>')
+
+CATALOG = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+           '<catalog xmlns="http://www.unidata.ucar.edu/namespaces/thredds/InvCatalog/v1.0" '
+           'xmlns:xlink="http://www.w3.org/1999/xlink" version="1.0.1">\n'
+           '  <service name="all" serviceType="Compound" base="">\n'
+           '    <service name="odap" serviceType="OPENDAP" base="/thredds/dodsC/"/>\n'
+           '    <service name="ncml" serviceType="NCML" base="/thredds/ncml/"/>\n'
+           '  </service>\n'
+           '  <dataset name="run" ID="run">\n'
+           '    <metadata inherited="true"><serviceName>all</serviceName></metadata>\n'
+           '    <dataset name="f0.nc" ID="run/f0.nc" urlPath="run/f0.nc">\n'
+           '      <dataSize units="Mbytes">1.5</dataSize>\n'
+           '    </dataset>\n'
+           '    <catalogRef xlink:href="day1/catalog.xml" xlink:title="day1" ID="run/day1" name=""/>\n'
+           '    <dataset name="members">\n'
+           '      <dataset name="m1.nc" ID="run/members/m1.nc" urlPath="run/members/m1.nc"/>\n'
+           '      <dataset name="inner" ID="run/members/inner">\n'
+           '        <dataset name="m2.nc" urlPath="run/members/inner/m2.nc"/>\n'
+           '        <catalogRef xlink:href="deep/catalog.xml" xlink:title="deep" name=""/>\n'
+           '      </dataset>\n'
+           '    </dataset>\n'
+           '    <dataset name="f1.nc" ID="run/f1.nc" urlPath="run/f1.nc"/>\n'
+           '    <catalogRef xlink:href="day2/catalog.xml" xlink:title="day2" ID="run/day2" name=""/>\n'
+           '  </dataset>\n'
+           '</catalog>\n')
+
+
+class _Loader:
+    concurrency = 4
+    opendap_base_url = "thredds/dodsC/"
+
+    def load_opendap_array(self, uri, variable, count):
+        return numpy.arange(count, dtype=numpy.float64)
+
+
+def test_concurrent_submits_register_a_schema_once(tmpdir, monkeypatch):
+    index = DatasetsIndex("http://server/", _Loader(), {"time": lambda values: values}, multi_schema=True)
+    index.open_stream(str(tmpdir / "index.ndjson"))
+    logged = []
+
+    def slow_info(msg):
+        # widens the gap between looking up and registering a schema
+        logged.append(msg)
+        time.sleep(0.05)
+
+    monkeypatch.setattr(model.logger, "info", slow_info)
+    datasets = [parse_ncml_file(NCML, "base/f%d.nc" % i) for i in range(16)]
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(index.submit_dataset, datasets))
+    index.close_stream()
+
+    assert len([msg for msg in logged if msg.startswith("New schema")]) == 1
+    saved = load_index(str(tmpdir / "index.ndjson"))
+    assert len(saved["schemas"]) == 1
+    assert sorted(ds["id"] for ds in saved["datasets"]) == sorted(dsi.id for dsi in datasets)
+    assert all(ds["data"]["time"] == [0.0, 1.0, 2.0] for ds in saved["datasets"])
+
+
+@pytest.mark.parametrize("as_input", [lambda catalog: catalog, lambda catalog: catalog.encode("utf-8"),
+                                      lambda catalog: etree.fromstring(catalog.encode("utf-8"))])
+def test_catalog_from_xml_data(as_input):
+    catalog = catalog_from_xml_data(as_input(CATALOG))
+    assert catalog.name == "run"
+    assert (catalog.opendap_base_url, catalog.ncml_base_url) == ("/thredds/dodsC/", "/thredds/ncml/")
+    # all nested datasets and catalog refs in document order
+    assert [(dsi.id, dsi.name, dsi.url_path, dsi.size) for dsi in catalog.datasets] == [
+        ("run/f0.nc", "f0.nc", "run/f0.nc", "1.5Mbytes"),
+        ("members", "members", None, "size unknown"),
+        ("run/members/m1.nc", "m1.nc", "run/members/m1.nc", "size unknown"),
+        ("run/members/inner", "inner", None, "size unknown"),
+        ("m2.nc", "m2.nc", "run/members/inner/m2.nc", "size unknown"),
+        ("run/f1.nc", "f1.nc", "run/f1.nc", "size unknown"),
+    ]
+    assert [dict(ref) for ref in catalog.catalog_refs] == [
+        {"href": "day1/catalog.xml", "title": "day1", "id": "run/day1"},
+        {"href": "deep/catalog.xml", "title": "deep", "id": "deep"},
+        {"href": "day2/catalog.xml", "title": "day2", "id": "run/day2"},
+    ]
+
+    # datasets are linked to their direct parent and children only
+    by_id = {dsi.id: dsi for dsi in catalog.datasets}
+    assert [child.id for child in by_id["members"].children] == ["run/members/m1.nc", "run/members/inner"]
+    assert [child.id for child in by_id["run/members/inner"].children] == ["m2.nc"]
+    assert by_id["m2.nc"].parent is by_id["run/members/inner"]
+    assert by_id["run/members/inner"].parent is by_id["members"]
+    assert by_id["members"].parent is None and by_id["run/f0.nc"].children == []
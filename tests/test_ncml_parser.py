@@ -0,0 +1,76 @@
+import pytest
+from lxml import etree
+
+from data.ncml_parser import parse_ncml_file
+
+NCML = ('<?xml version="1.0"?>\n'
+        '<netcdf xmlns="http://www.unidata.ucar.edu/namespaces/netcdf/ncml-2.2" location="dods://server/run/f.nc">\n'
+        '  <dimension name="time" length="4" isUnlimited="true"/>\n'
+        '  <dimension name="lat" length="3"/>\n'
+        '  <dimension name="lon" length="5"/>\n'
+        '  <attribute name="title" value="ICON run"/>\n'
+        '  <attribute name="number_of_grid_used" type="int" value="42"/>\n'
+        '  <attribute name="missing" type="double" value="-9e33"/>\n'
+        '  <variable name="time" shape="time" type="double">\n'
+        '    <attribute name="units" value="day as %Y%m%d.%f"/>\n'
+        '    <attribute name="calendar" value="proleptic_gregorian"/>\n'
+        '  </variable>\n'
+        '  <variable name="lat" shape="lat" type="float">\n'
+        '    <attribute name="standard_name" value="latitude"/>\n'
+        '    <attribute name="valid_range" type="float" value="-90.0"/>\n'
+        '  </variable>\n'
+        '  <variable name="t" shape="time lat lon" type="float">\n'
+        '    <attribute name="long_name" value="Temperature"/>\n'
+        '    <attribute name="code" type="short" value="130"/>\n'
+        '  </variable>\n'
+        '  <group name="THREDDSMetadata">\n'
+        '    <group name="services">\n'
+        '      <attribute name="opendap_service" value="/thredds/dodsC/run/f.nc"/>\n'
+        '    </group>\n'
+        '    <attribute name="id" value="run/f.nc"/>\n'
+        '    <attribute name="title" value="not a global attribute"/>\n'
+        '  </group>\n'
+        '</netcdf>\n')
+
+EXPECTED = {
+    "dimensions": {"time": "4", "lat": "3", "lon": "5"},
+    "variables": {
+        "time": {"type": "double", "shape": ["time"],
+                 "attributes": {"units": {"value": "day as %Y%m%d.%f"}, "calendar": {"value": "proleptic_gregorian"}}},
+        "lat": {"type": "float", "shape": ["lat"],
+                "attributes": {"standard_name": {"value": "latitude"}, "valid_range": {"value": -90.0}}},
+        "t": {"type": "float", "shape": ["time", "lat", "lon"],
+              "attributes": {"long_name": {"value": "Temperature"}, "code": {"value": 130}}},
+    },
+    # attributes of groups are not global attributes
+    "attributes": {"title": {"value": "ICON run"}, "number_of_grid_used": {"value": 42}, "missing": {"value": -9e33}},
+}
+
+
+def _file(ncml, tmpdir):
+    tmpdir.join("f.ncml").write(ncml)
+    return str(tmpdir.join("f.ncml"))
+
+
+@pytest.mark.parametrize("as_input", [lambda ncml, tmpdir: ncml,
+                                      lambda ncml, tmpdir: ncml.encode("utf-8"),
+                                      _file])
+def test_parse_ncml_file(tmpdir, as_input):
+    dsi = parse_ncml_file(as_input(NCML, tmpdir), "fallback.nc")
+    # the id of the THREDDS metadata wins
+    assert dsi.id == "run/f.nc"
+    assert dsi.meta.toJson() == EXPECTED
+    assert list(dsi.meta.variables) == ["time", "lat", "t"]
+    assert dsi.meta.variables["t"].shape == ["time", "lat", "lon"]
+
+
+def test_parse_ncml_element_is_not_modified():
+    element = etree.fromstring(NCML.encode("utf-8"))
+    dsi = parse_ncml_file(element, "fallback.nc")
+    assert dsi.meta.toJson() == EXPECTED
+    assert etree.tostring(element) == etree.tostring(etree.fromstring(NCML.encode("utf-8")))
+
+
+def test_parse_ncml_without_thredds_metadata_keeps_the_id():
+    ncml = NCML[:NCML.index("  <group")] + "</netcdf>\n"
+    assert parse_ncml_file(ncml, "fallback.nc").id == "fallback.nc"
@@ -0,0 +1,55 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from data.provider import CachedOrRemoteProvider, RemoteProvider
+
+REQUESTS = 40
+
+
+def test_sequential_requests_reuse_one_connection(stand_in_server):
+    server = stand_in_server({"/data": b"payload"})
+    provider = RemoteProvider(server.url, pool_size=4)
+
+    for _ in range(REQUESTS):
+        assert provider.request(server.url + "data") == b"payload"
+
+    assert server.requests["/data"] == REQUESTS
+    assert server.connections == 1
+
+
+def test_concurrent_requests_are_bounded_by_the_pool_size(stand_in_server):
+    server = stand_in_server({"/data": b"payload"})
+    provider = RemoteProvider(server.url, pool_size=4)
+
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        bodies = list(executor.map(lambda _: provider.request(server.url + "data"), range(REQUESTS)))
+
+    assert bodies == [b"payload"] * REQUESTS
+    assert server.requests["/data"] == REQUESTS
+    assert 1 <= server.connections <= 4
+
+
+def _validators(cache_dir):
+    return [path.basename for path in cache_dir.visit() if path.basename.endswith(".validators.json")]
+
+
+def test_validators_are_only_saved_for_revalidation(stand_in_server, tmpdir):
+    def tagged():
+        if server.request_headers["/tagged"].get("If-None-Match") == '"v1"':
+            return 304, b"", {"ETag": '"v1"'}
+        return 200, b"tagged", {"ETag": '"v1"'}
+
+    server = stand_in_server({"/tagged": tagged, "/untagged": b"untagged"})
+    plain_dir, revalidated_dir = tmpdir.join("plain"), tmpdir.join("revalidated")
+
+    provider = CachedOrRemoteProvider(str(plain_dir), server.url)
+    assert provider.get_str_data("tagged") == b"tagged"
+    assert _validators(plain_dir) == []
+
+    provider = CachedOrRemoteProvider(str(revalidated_dir), server.url, revalidate=True)
+    assert provider.get_str_data("tagged") == b"tagged"
+    assert provider.get_str_data("untagged") == b"untagged"
+    assert len(_validators(revalidated_dir)) == 1
+
+    # served from the cache after a 304
+    assert provider.get_str_data("tagged") == b"tagged"
+    assert server.requests["/tagged"] == 3
@@ -0,0 +1,73 @@
+import os
+import socket
+import subprocess
+import sys
+import threading
+
+import numpy
+
+from data import slice_cache
+from data.slice_cache import SliceCache
+
+
+def test_evicted_slices_are_spilled_and_memory_mapped(tmpdir):
+    cache = SliceCache(max_bytes=100, spill_dir=str(tmpdir))
+    first, second = numpy.arange(10.0), numpy.arange(10.0) + 1
+    cache.put("first", first)
+    cache.put("second", second)
+
+    assert cache.stats()["spilled_entries"] == 1
+    spilled = cache.get("first")
+    assert isinstance(spilled, numpy.memmap)
+    assert (spilled == first).all()
+    assert cache.stats()["spill_hits"] == 1
+
+
+def test_spilling_does_not_block_lookups(tmpdir, monkeypatch):
+    cache = SliceCache(max_bytes=100, spill_dir=str(tmpdir))
+    cache.put("first", numpy.arange(10.0))
+
+    saving = threading.Event()
+    release = threading.Event()
+    save = numpy.save
+
+    def slow_save(*args):
+        saving.set()
+        release.wait(5)
+        save(*args)
+
+    monkeypatch.setattr(slice_cache.numpy, "save", slow_save)
+    writer = threading.Thread(target=cache.put, args=("second", numpy.arange(10.0)))
+    writer.start()
+    assert saving.wait(5)
+
+    # the slice being spilled is still served from memory
+    looked_up = []
+    reader = threading.Thread(target=lambda: looked_up.append(cache.get("first")))
+    reader.start()
+    reader.join(1)
+    assert looked_up and (looked_up[0] == numpy.arange(10.0)).all()
+
+    release.set()
+    writer.join(5)
+    assert isinstance(cache.get("first"), numpy.memmap)
+
+
+def test_each_process_spills_into_its_own_cleared_directory(tmpdir):
+    host = socket.gethostname()
+    exited = subprocess.Popen([sys.executable, "-c", "pass"])
+    exited.wait()
+    for owner in ("%s-%d" % (host, exited.pid), "%s-%d" % (host, os.getpid()), "%s-%d" % (host, os.getppid()),
+                  "otherhost-%d" % exited.pid):
+        tmpdir.mkdir(owner).join("left.npy").write("x")
+
+    cache = SliceCache(max_bytes=100, spill_dir=str(tmpdir), max_spill_bytes=100)
+    for i in range(4):
+        cache.put(i, numpy.arange(10.0) + i)
+
+    # directories of running processes and of other hosts are kept
+    assert sorted(path.basename for path in tmpdir.listdir()) == sorted(
+        ["%s-%d" % (host, os.getpid()), "%s-%d" % (host, os.getppid()), "otherhost-%d" % exited.pid])
+    assert [path.basename for path in tmpdir.join("%s-%d" % (host, os.getpid())).listdir()] == [
+        cache._spill_path(2).name]
+    assert (cache.get(2) == numpy.arange(10.0) + 2).all()
@@ -0,0 +1,50 @@
+import os
+import pickle
+import stat
+
+import numpy
+import pytest
+
+from util import DotDict, excel2time, excel2time_array, write_file, write_file_atomic
+
+
+def test_dot_dict_pickles():
+    meta = DotDict(name="t", attributes=DotDict(units="K"))
+    loaded = pickle.loads(pickle.dumps(meta, pickle.HIGHEST_PROTOCOL))
+    assert loaded == meta
+    assert isinstance(loaded.attributes, DotDict)
+    assert loaded.attributes.units == "K"
+    assert loaded.missing is None
+
+
+def test_atomically_written_files_get_the_default_permissions(tmpdir):
+    write_file(b"plain", str(tmpdir / "plain"), "wb")
+    write_file_atomic(b"atomic", str(tmpdir / "atomic"), "wb")
+    modes = [stat.S_IMODE(os.stat(str(tmpdir / name)).st_mode) for name in ("plain", "atomic")]
+    assert modes[0] == modes[1]
+
+
+def _old_format(value):
+    # the per-value formatter of preprocess.py that `excel2time_array` replaced
+    return str((excel2time(float(value)) + numpy.timedelta64(500, "ms")).astype("datetime64[s]"))
+
+
+def _around(value):
+    return [numpy.nextafter(value, 0), value, numpy.nextafter(value, numpy.inf)]
+
+
+def test_excel2time_array_matches_the_per_value_formatter():
+    day = 20160322.0
+    values = [19700101.0, 19700101.5, 20160229.0, 20000229.75, 20240229.999988426, 21000228.5, 20161231.99999]
+    # half seconds, where rounding changes, and the end of the day
+    for seconds in (0.5, 59.5, 3599.5, 43199.5, 86399.5, 86399.9):
+        values += _around(day + seconds / 86400)
+    values += [day + quarter / 96 for quarter in range(96)]
+
+    expected = [_old_format(value) for value in values]
+    assert numpy.datetime_as_string(excel2time_array(values), unit="s").tolist() == expected
+
+
+def test_excel2time_array_rejects_invalid_dates():
+    with pytest.raises(ValueError):
+        excel2time_array([20160322.5, 21000229.5])
@@ -1,9 +1,17 @@
 import logging
+import os
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from typing import Union
 from pathlib import Path
 
 logger = logging.getLogger("opendapViz")
 
+# read once, changing the umask to read it is not thread safe
+_umask = os.umask(0)
+os.umask(_umask)
+
 
 def read_file(file_path: Union[str, Path], mode="rb"):
     file_path = Path(file_path) if isinstance(file_path, str) else file_path
@@ -31,6 +39,26 @@ def write_file(content, full_path: Union[str, Path], mode="wb"):
     logger.debug("File written to: %s", full_path)
 
 
+def write_file_atomic(content, full_path: Union[str, Path], mode="wb"):
+    """
+    Like `write_file`, but readers never see a partially written file: the content is written to a temporary file
+    next to the target, which then replaces it.
+    """
+    full_path = Path(full_path) if isinstance(full_path, str) else full_path
+    full_path.parent.mkdir(parents=True, exist_ok=True)
+
+    fd, tmp_path = tempfile.mkstemp(dir=str(full_path.parent), prefix=".tmp-")
+    try:
+        with os.fdopen(fd, mode) as file:
+            file.write(content)
+        # temporary files are private, the file gets the permissions `write_file` would give it
+        os.chmod(tmp_path, 0o666 & ~_umask)
+        os.replace(tmp_path, str(full_path))
+    except Exception:
+        os.unlink(tmp_path)
+        raise
+    logger.debug("File written to: %s", full_path)
+
 
 class DotDict(dict):
 
@@ -38,11 +66,30 @@ class DotDict(dict):
         return self.get(item)
 
     def __getattr__(self, item):
+        if item.startswith("__"):
+            # special methods looked up by e.g. pickle, `__getstate__` exists on `object` only since Python 3.11
+            raise AttributeError(item)
         return self.get(item)
 
 
+_shared_executors = {}
+_shared_executors_lock = threading.Lock()
+
+
+def get_shared_executor(name, max_workers):
+    """
+    Thread pool `name` shared by the whole process, e.g. by all sessions of the bokeh server. `max_workers` is only
+    used when it is created by the first call.
+    """
+    with _shared_executors_lock:
+        if name not in _shared_executors:
+            _shared_executors[name] = ThreadPoolExecutor(max_workers=max_workers)
+        return _shared_executors[name]
+
+
 """Transform datetime of EXCEL-float to Python object."""
 
+import numpy as np
 import pandas as pd
 import decimal as dc
 
@@ -74,4 +121,30 @@ def excel2time(excel, mode='numpy', *args, **kwargs):
         return timestamp.to_julian_date()
     else:
         message = 'Expected "numpy, julian, datetime", got "{}"'.format(mode)
-        raise ValueError(message)
\ No newline at end of file
+        raise ValueError(message)
+
+def excel2time_array(excel, unit='s') -> np.ndarray:
+    """
+    Vectorised version of `excel2time`, rounded to the nearest `unit`.
+
+    Matches `excel2time` value by value: the integer part is read as YYYYMMDD, the fractional part as fraction of a
+    day truncated to nanoseconds.
+    """
+    excel = np.asarray(excel, dtype=np.float64)
+    day = np.floor(excel)
+    # the fractional part of a double is exact, as is the decimal string split
+    perc_ns = ((excel - day) * 86400e9).astype(np.int64)
+
+    day = day.astype(np.int64)
+    month, mday = day // 100 % 100, day % 100
+    months = (day // 10000 - 1970).astype('datetime64[Y]').astype('datetime64[M]')
+    months = months + (month - 1).astype('timedelta64[M]')
+    dates = months.astype('datetime64[D]') + (mday - 1).astype('timedelta64[D]')
+    invalid = (month < 1) | (month > 12) | (mday < 1) | (dates.astype('datetime64[M]') != months)
+    if invalid.any():
+        message = 'Expected dates as YYYYMMDD, got {}'.format(excel[invalid][0])
+        raise ValueError(message)
+    timestamps = dates.astype('datetime64[ns]') + perc_ns.astype('timedelta64[ns]')
+
+    half_unit = np.timedelta64(1, unit).astype('timedelta64[ns]') // 2
+    return (timestamps + half_unit).astype('datetime64[%s]' % unit)
@@ -1,4 +1,4 @@
-import json
+import os
 import re
 from datetime import datetime
 from functools import partial
@@ -11,11 +11,15 @@ import xarray as xr
 from bokeh.io import curdoc
 from bokeh.layouts import layout, column, row
 from bokeh.models import ColumnDataSource, TableColumn, DataTable, Button, Panel, Div, DatePicker, Tabs, HoverTool
-from bokeh.models.widgets import Toggle, Slider, TextInput
+from bokeh.models.widgets import Toggle, Slider, TextInput, Select
 from cartopy import crs as ccrs
 
 hv.extension('bokeh')
-from util import read_file, logger, DotDict
+from data.index_io import load_index
+from data.provider import RemoteProvider
+from data.remote_array import LayerPrefetcher, LayerPyramid, open_layer_pyramid, open_remote_dataarray
+from data.slice_cache import get_slice_cache, DEFAULT_MAX_BYTES, DEFAULT_MAX_SPILL_BYTES
+from util import logger, DotDict, get_shared_executor
 
 
 def value_changed(attr, old, new):
@@ -43,8 +47,27 @@ status_bar = Div(text="Select a varaible to plot",
                         "background": "blue", "line-height": "30px", "z-index": 1000, "padding-left": 16}, height=30)
 
 
+# shared by all sessions of the server, configured by the environment of `bokeh serve`
+slice_cache = get_slice_cache(
+    int(os.environ.get("OPENDAPVIZ_SLICE_CACHE_MB", DEFAULT_MAX_BYTES // 2 ** 20)) * 2 ** 20,
+    os.environ.get("OPENDAPVIZ_SLICE_SPILL_DIR"),
+    int(os.environ.get("OPENDAPVIZ_SLICE_SPILL_MB", DEFAULT_MAX_SPILL_BYTES // 2 ** 20)) * 2 ** 20)
+# loads the data of plots outside of the IO loop, shared by all sessions as well
+plot_executor = get_shared_executor("plots", int(os.environ.get("OPENDAPVIZ_PLOT_WORKERS", 4)))
+# loads layers and datasets likely to be plotted next into the slice cache
+prefetch_executor = get_shared_executor("prefetch", int(os.environ.get("OPENDAPVIZ_PREFETCH_WORKERS", 2)))
+
+
+def slice_cache_stats():
+    stats = slice_cache.stats()
+    return ("Slice cache: %d hits, %d spill hits, %d misses, %d entries (%.1f MB), %d spilled (%.1f MB)" %
+            (stats["hits"], stats["spill_hits"], stats["misses"], stats["entries"], stats["bytes"] / 2 ** 20,
+             stats["spilled_entries"], stats["spilled_bytes"] / 2 ** 20))
+
+
 def load_file(index_file_name):
-    index = json.loads(read_file(index_file_name, "r"))
+    index = load_index(index_file_name)
+    opendap_provider = RemoteProvider(index["opendap_url"])
 
     def date_range_change(is_start, attr, old, new):
         print(is_start, new)
@@ -53,7 +76,8 @@ def load_file(index_file_name):
         end = endDate.value
         end = datetime(end.year, end.month, end.day, 23, 59, 59)
         print(type(start), end)
-        filter_func = lambda ds: any(map(lambda dt: start <= dt and dt <= end, ds["_time_values"]))
+        start, end = np.datetime64(start, "s"), np.datetime64(end, "s")
+        filter_func = lambda ds: ((start <= ds["_time_values"]) & (ds["_time_values"] <= end)).any()
         dsTable.filter_datasets(filter_func)
 
     def name_filter_changed(attr, old, new):
@@ -64,19 +88,44 @@ def load_file(index_file_name):
     class DatasetsTable:
 
         def __init__(self, index):
-            self.meta_data = DotDict(index["meta"])
-            self.datasets = index["datasets"]
-            self.meta_variables = self.meta_data.variables
+            self.all_datasets = index["datasets"]
+            # indexes without schemas contain a single one
+            self.schemas = index.get("schemas") or {None: index["meta"]}
+            self._use_schema(index.get("default_schema"))
             self._fill_variables_table()
             self._fill_datasets_table()
 
-        def _fill_variables_table(self):
+        def _use_schema(self, schema):
+            self.schema = schema
+            self.meta_data = DotDict(self.schemas[schema])
+            self.meta_variables = self.meta_data.variables
+            self.datasets = list(filter(lambda ds: ds.get("schema", schema) == schema, self.all_datasets))
+
+        def schema_options(self):
+            options = []
+            for schema in self.schemas:
+                datasets = list(filter(lambda ds: ds.get("schema", schema) == schema, self.all_datasets))
+                if datasets:
+                    options.append((schema, "%s (%d datasets)" % (datasets[0]["id"], len(datasets))))
+            return options
+
+        def select_schema(self, schema):
+            self._use_schema(schema)
+            self.vars_source.selected.indices = []
+            self.vars_source.data.update(self._populate_variables_table_data())
+            self.datasets_source.selected.indices = []
+            self.filter_datasets(lambda ds: True)
+
+        def _populate_variables_table_data(self):
             self.vars_short_names = list(self.meta_variables.keys())
 
             vars_names = list(map(self.to_long_name, self.vars_short_names))
             vars_dims = list(
                 map(lambda v: ", ".join(list(map(self.to_long_name, v["shape"]))), self.meta_variables.values()))
-            self.vars_data = dict(names=vars_names, dims=vars_dims, )
+            return dict(names=vars_names, dims=vars_dims, )
+
+        def _fill_variables_table(self):
+            self.vars_data = self._populate_variables_table_data()
             self.vars_source = ColumnDataSource(self.vars_data)
             vars_columns = [
                 TableColumn(field="names", title="Variable name"),
@@ -110,10 +159,11 @@ def load_file(index_file_name):
             # preprocess the time values
             max_date = min_date = None
 
-            for ds in self.datasets:
-                ds["_time_values"] = list(map(lambda t: np.datetime64(t).astype(datetime), ds["data"]["time"]))
-                mx = max(ds["_time_values"])
-                mn = min(ds["_time_values"])
+            for ds in self.all_datasets:
+                # datetime64 arrays: columnar indexes already store them, JSON indexes store ISO strings
+                ds["_time_values"] = np.asarray(ds["data"]["time"], dtype="datetime64[s]")
+                mx = ds["_time_values"].max().astype(datetime)
+                mn = ds["_time_values"].min().astype(datetime)
                 if max_date is None or mx > max_date:
                     max_date = mx
                 if min_date is None or mn < min_date:
@@ -140,7 +190,7 @@ def load_file(index_file_name):
             ds_dates = []
             for ds in datasets:
                 ds_names.append(ds["id"])
-                ds_dates.append(ds["data"]["time"][0])  # todo format date
+                ds_dates.append(str(ds["data"]["time"][0]))  # todo format date
             return {"names": ds_names, "dates": ds_dates}
 
         def get_plot_infos(self):
@@ -154,48 +204,185 @@ def load_file(index_file_name):
             ds = self.filtered_datasets[ds_index[0]]
             return (ds, var_name, var["shape"])
 
-    def gen_plot():
-        infos = dsTable.get_plot_infos()
-        if infos is None:
-            return
-        ds, var_name, shape = infos
-        ds_uri = ds["id"]
-        timestamp = ds["data"]["time"][0]
-        file_name = ds_uri.split("/")[-1]
-        kdims = shape
-        vdims = [var_name]
-
-        lon_key, lat_key = None, None
-        for key in dsTable.meta_variables:
-            entry = dsTable.meta_variables[key]
-            if "attributes" not in entry or "standard_name" not in entry["attributes"]:
-                continue
-            if entry["attributes"]["standard_name"]["value"] == "longitude":
-                lon_key = key
-
-            if entry["attributes"]["standard_name"]["value"] == "latitude":
-                lat_key = key
-
-        if lat_key not in kdims or lon_key not in kdims:
-            log("'lat' and 'lon' are required dimensions!")
+        def dataset_after(self, ds):
+            """The dataset following `ds` in the filtered table, if any."""
+            for position, other in enumerate(self.filtered_datasets[:-1]):
+                if other is ds:
+                    return self.filtered_datasets[position + 1]
+            return None
+
+    def background_image(load, load_cached, kdims, streams):
+        """
+        DynamicMap showing the images returned by `load(*kdim_values, **stream_values)`. Except for the first image,
+        whose data `load_plot_data` already fetched, `load` runs on the plot executor and the image shown before stays
+        until it returns. Only the image of the latest slider values and viewport is shown, older loads are dropped.
+
+        :param load_cached: like `load` but only returns an image if it needs no requests, None otherwise. Runs on
+            the IO loop.
+        """
+        # the latest view, the image loaded for it and the image shown last
+        view_request = {"token": 0, "future": None, "loaded": None, "image": None}
+        refresh = hv.streams.Stream.define("Refresh")()
+
+        def load_view(view, args, kwargs):
+            """Runs on the plot executor, None if the view changed in between."""
+            if view != view_request["token"]:
+                return None
+            return load(*args, **kwargs)
+
+        def show_view(view, future, view_key):
+            """Runs on the IO loop, shows the loaded image by triggering the map again."""
+            if view != view_request["token"] or future.cancelled():
+                return
+            try:
+                loaded = future.result()
+            except Exception as e:
+                log("Failed to load the image", e)
+                return
+            if loaded is not None:
+                view_request["loaded"] = (view_key, loaded)
+                refresh.event()
+
+        def show(*args, **kwargs):
+            view_key = (args, tuple(sorted(kwargs.items())))
+            if view_request["loaded"] is not None and view_request["loaded"][0] == view_key:
+                image = view_request["loaded"][1]
+            elif view_request["image"] is None:
+                image = load(*args, **kwargs)
+            else:
+                image = load_cached(*args, **kwargs)
+            view_request["loaded"] = None
+
+            # supersedes the load of an older view
+            if view_request["future"] is not None:
+                view_request["future"].cancel()
+            view_request["token"] += 1
+            if image is None:
+                view = view_request["token"]
+                log("Loading data...")
+                future = plot_executor.submit(load_view, view, args, kwargs)
+                future.add_done_callback(lambda done: doc.add_next_tick_callback(
+                    partial(show_view, view, done, view_key)))
+                view_request["future"] = future
+                return view_request["image"]
+            view_request["future"] = None
+            view_request["image"] = image
+            return image
+
+        return hv.DynamicMap(show, kdims=kdims, streams=streams + [refresh])
+
+    def multi_resolution_image(pyramid, var_name, lon_key, lat_key):
+        """
+        Image following the viewport: zooming in refines it, the number of values sent stays bounded by the plot
+        size. Layers are selected with sliders for the leading dimensions with more than one value.
+
+        :return: the image and the dimensions with more than one value
+        """
+        layer_coords = list(pyramid.coords.items())[:-2]
+        sliders = [(dim, values) for dim, values in layer_coords if len(values) > 1]
+        group = dsTable.to_long_name(var_name, True) + "  "
+        prefetcher = LayerPrefetcher(pyramid.region, [len(values) for _, values in layer_coords], prefetch_executor)
+
+        def load_image(*slider_values, x_range=None, y_range=None, cached_only=False):
+            selected = dict(zip([dim for dim, _ in sliders], slider_values))
+            layer = [int(np.argmin(np.abs(values - selected[dim]))) if dim in selected else 0
+                     for dim, values in layer_coords]
+            region = pyramid.region(layer, x_range, y_range, cached_only)
+            if region is None:
+                return None
+            lon, lat, values = region
+            prefetcher.shown(layer, x_range, y_range)
+            data = xr.DataArray(values, coords=[(lat_key, lat), (lon_key, lon)], name=var_name)
+            return gv.Image(data, [lon_key, lat_key], group=group, crs=ccrs.PlateCarree())
+
+        image = background_image(load_image, partial(load_image, cached_only=True),
+                                 [hv.Dimension(dim, values=values.tolist()) for dim, values in sliders],
+                                 [hv.streams.RangeXY()])
+        return image, [dim for dim, _ in sliders] + [lat_key, lon_key]
+
+    def lazy_image(data_array, var_name, lon_key, lat_key):
+        """
+        Image of the whole map, each layer selected with the sliders is requested on its own.
+
+        :return: the image and the dimensions with more than one value
+        """
+        sliders = [dim for dim in data_array.dims if dim not in (lat_key, lon_key)]
+        group = dsTable.to_long_name(var_name, True) + "  "
+
+        def load_image(*slider_values):
+            layer = data_array.sel(dict(zip(sliders, slider_values)), method="nearest")
+            return gv.Image(layer.load(), [lon_key, lat_key], group=group, crs=ccrs.PlateCarree())
+
+        # each layer is cached in the slice cache, but the lazy array can not tell without loading it
+        image = background_image(load_image, lambda *slider_values: None,
+                                 [hv.Dimension(dim, values=list(data_array[dim].values)) for dim in sliders], [])
+        return image, sliders + [lat_key, lon_key]
+
+    # the latest plot request, older ones stop at their next step
+    plot_request = {"token": 0, "future": None}
+
+    def superseded(token):
+        # prefetches of the next dataset have no token and run to the end
+        return token is not None and token != plot_request["token"]
+
+    def report(token, msg):
+        """Shows the progress of a plot request in the status bar, called from the plot executor."""
+        if token == plot_request["token"]:
+            doc.add_next_tick_callback(partial(log, msg))
+
+    def load_plot_data(token, full_url, var_name, kdims, lon_key, lat_key):
+        """
+        Runs on the plot executor: opens the dataset and loads the first layer into the slice cache, so rendering
+        on the IO loop does not wait for the server.
+
+        :return: the `LayerPyramid` or lazy data array and the dimensions with more than one value, None if the
+            request was superseded
+        """
+        report(token, "Opening dataset: " + full_url)
+        if list(kdims[-2:]) == [lat_key, lon_key]:
+            pyramid = open_layer_pyramid(opendap_provider, full_url, var_name, dsTable.meta_data,
+                                         cache=slice_cache)
+            if superseded(token):
+                return None
+            report(token, "Dataset successfully opened. Loading data...")
+            pyramid.region([0] * (len(kdims) - 2))
+            return pyramid, None
+
+        # lazy, each displayed layer is requested on its own
+        data_array = open_remote_dataarray(opendap_provider, full_url, var_name, dsTable.meta_data,
+                                           cache=slice_cache)
+        if superseded(token):
+            return None
+        report(token, "Dataset successfully opened. Loading data...")
+        kdimsSingularValue = list(filter(lambda dim: data_array[dim].size == 1, kdims))
+        kdimsMultipleValues = list(filter(lambda dim: data_array[dim].size > 1, kdims))
+        indexers = {key: 0 for key in kdimsSingularValue}
+        data_array = data_array.isel(**indexers)
+        data_array.isel(**{dim: 0 for dim in data_array.dims if dim not in (lat_key, lon_key)}).load()
+        return data_array, kdimsMultipleValues
+
+    def prefetch_dataset(full_url, var_name, kdims, lon_key, lat_key):
+        try:
+            load_plot_data(None, full_url, var_name, kdims, lon_key, lat_key)
+        except Exception as e:
+            logger.debug("Failed to prefetch %s: %s" % (full_url, e))
+
+    def show_plot(token, future, full_url, next_url, timestamp, var_name, kdims, lon_key, lat_key):
+        """
+        Renders the data loaded by `load_plot_data`, runs on the IO loop. Afterwards the same variable of `next_url`
+        is prefetched.
+        """
+        if token != plot_request["token"] or future.cancelled():
             return
-        full_url = index["opendap_url"] + ds_uri
-        log("Opening dataset: " + full_url)
-        btn_plot_lonXlat.disabled = True
         try:
-            print("Opening : " + full_url)
-            dataset = xr.open_dataset(full_url)
-            log("Dataset successfully opened. Loading data...")
-            kdimsSingularValue = list(filter(lambda dim: dataset[dim].size == 1, kdims))
-            kdimsMultipleValues = list(filter(lambda dim: dataset[dim].size > 1, kdims))
-            indexers = {key: dataset[key].values[0] for key in kdimsSingularValue}
-            print(indexers)
-            dataset = dataset.sel(indexers=indexers)
-            print(kdimsMultipleValues, kdimsSingularValue)
-
-            xr_dataset = gv.Dataset(dataset[var_name], group=dsTable.to_long_name(var_name, True) + "  ",
-                                    crs=ccrs.PlateCarree())
-            image = xr_dataset.to(gv.Image, [lon_key, lat_key], dynamic=True)
+            loaded = future.result()
+            if loaded is None:
+                return
+            log("Rendering plot...")
+            if isinstance(loaded[0], LayerPyramid):
+                image, kdimsMultipleValues = multi_resolution_image(loaded[0], var_name, lon_key, lat_key)
+            else:
+                image, kdimsMultipleValues = lazy_image(loaded[0], var_name, lon_key, lat_key)
 
             graph = image.options(colorbar=True, tools=['hover'],cmap="viridis", width=800, height=640, colorbar_position="right",
                                   toolbar="below") * gf.coastline()
@@ -242,8 +429,49 @@ def load_file(index_file_name):
             log("Data successfully loaded!")
         except Exception as e:
             log("Failed to open or process dataset: %s" % full_url, e)
-        finally:
-            btn_plot_lonXlat.disabled = False
+            return
+        if next_url is not None:
+            prefetch_executor.submit(prefetch_dataset, next_url, var_name, kdims, lon_key, lat_key)
+
+    def gen_plot():
+        infos = dsTable.get_plot_infos()
+        if infos is None:
+            return
+        ds, var_name, shape = infos
+        ds_uri = ds["id"]
+        timestamp = str(ds["data"]["time"][0])
+        file_name = ds_uri.split("/")[-1]
+        kdims = shape
+        vdims = [var_name]
+
+        lon_key, lat_key = None, None
+        for key in dsTable.meta_variables:
+            entry = dsTable.meta_variables[key]
+            if "attributes" not in entry or "standard_name" not in entry["attributes"]:
+                continue
+            if entry["attributes"]["standard_name"]["value"] == "longitude":
+                lon_key = key
+
+            if entry["attributes"]["standard_name"]["value"] == "latitude":
+                lat_key = key
+
+        if lat_key not in kdims or lon_key not in kdims:
+            log("'lat' and 'lon' are required dimensions!")
+            return
+        full_url = index["opendap_url"] + ds_uri
+        next_ds = dsTable.dataset_after(ds)
+        next_url = index["opendap_url"] + next_ds["id"] if next_ds is not None else None
+        log("Opening dataset: " + full_url)
+
+        # supersede the running request, the IO loop stays free while the data is loaded
+        if plot_request["future"] is not None:
+            plot_request["future"].cancel()
+        plot_request["token"] += 1
+        token = plot_request["token"]
+        future = plot_executor.submit(load_plot_data, token, full_url, var_name, kdims, lon_key, lat_key)
+        future.add_done_callback(lambda done: doc.add_next_tick_callback(
+            partial(show_plot, token, done, full_url, next_url, timestamp, var_name, kdims, lon_key, lat_key)))
+        plot_request["future"] = future
 
     dsTable = DatasetsTable(index)
     btn_plot_lonXlat = Button(label="Plot variable over 'lon'x'lat' (this may take some time)")
@@ -256,12 +484,22 @@ def load_file(index_file_name):
     startDate.on_change("value", partial(date_range_change, True))
     endDate.on_change("value", partial(date_range_change, False))
 
+    filterWidgets = [startDate, endDate]
+    schemaOptions = dsTable.schema_options()
+    if len(schemaOptions) > 1:
+        schemaSelect = Select(title="Schema", options=schemaOptions, value=dsTable.schema)
+        schemaSelect.on_change("value", lambda attr, old, new: dsTable.select_schema(new))
+        filterWidgets.append(schemaSelect)
+
     plotTabs = Tabs(tabs=[], width=1000, height=640, )
 
+    cacheStats = Div(text=slice_cache_stats())
+    doc.add_periodic_callback(lambda: setattr(cacheStats, "text", slice_cache_stats()), 2000)
+
     plotLayout = column(plotTabs, name="plotLayout")
-    mainLayout = column(Div(height=50, style={"height": 50}), row(startDate, endDate), dsTable.datasets_table,
+    mainLayout = column(Div(height=50, style={"height": 50}), row(*filterWidgets), dsTable.datasets_table,
                         dsTable.vars_table, btn_plot_lonXlat,
-                        plotLayout, status_bar, name='mainLayout')
+                        plotLayout, cacheStats, status_bar, name='mainLayout')
 
     doc.remove_root(loadLayout)
     doc.add_root(mainLayout)